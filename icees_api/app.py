@@ -1,26 +1,27 @@
 """ICEES API entrypoint."""
 from functools import wraps
 import inspect
-import json
 import logging
 from logging.handlers import TimedRotatingFileHandler
 import os
 from pathlib import Path
 from time import strftime
-from typing import Any
+from typing import Any, Iterator
 
+from anyio import from_thread, to_thread
 from fastapi import Request, HTTPException
 from fastapi.encoders import jsonable_encoder
 from fastapi.responses import PlainTextResponse
 from jsonschema import ValidationError
-from starlette.responses import Response, JSONResponse
+from starlette.responses import Response, JSONResponse, StreamingResponse
 from structlog import wrap_logger
 from structlog.processors import JSONRenderer
 
-from .features import format_
+from .features import cache, columnar, fanout, format_, indexes
 
 from .handlers import ROUTER
 from .trapi import TRAPI
+from .utils import NDJSON, to_json
 
 CONFIG_PATH = os.getenv('CONFIG_PATH', './config')
 DESCRIPTION_FILE = Path(CONFIG_PATH) / "static" / "api_description.html"
@@ -31,23 +32,23 @@ OPENAPI_TITLE = os.getenv('OPENAPI_TITLE', 'ICEES API')
 OPENAPI_HOST = os.getenv('OPENAPI_HOST', 'localhost:8080')
 OPENAPI_SCHEME = os.getenv('OPENAPI_SCHEME', 'http')
 OPENAPI_SERVER_URL = os.getenv("OPENAPI_SERVER_URL")
+# threads running handlers and database access; unset keeps anyio's default (40)
+THREADPOOL_SIZE = os.getenv("THREADPOOL_SIZE")
 TOOL_VERSION = "6.0.0"
 
 
 class NaNResponse(JSONResponse):
-    """JSONResponse subclass inserting null for NaNs."""
+    """JSONResponse subclass inserting null for NaNs.
+
+    It also serializes NumPy values and namedtuples, so content need not
+    go through jsonable_encoder first.
+    """
 
     media_type = "application/json"
 
     def render(self, content: Any) -> bytes:
-        """Convert to str."""
-        return json.dumps(
-            content,
-            ensure_ascii=False,
-            allow_nan=True,
-            indent=None,
-            separators=(",", ":"),
-        ).replace(":NaN", ":null").encode("utf-8")
+        """Convert to bytes."""
+        return to_json(content)
 
 
 openapi_args = dict(
@@ -95,6 +96,26 @@ LOGGER.addHandler(HANDLER)
 LOGGER = wrap_logger(LOGGER, processors=[JSONRenderer()])
 
 
+@APP.on_event("startup")
+async def configure_threadpool():
+    """Size the thread pool that runs handlers and database access."""
+    if THREADPOOL_SIZE:
+        limiter = to_thread.current_default_thread_limiter()
+        limiter.total_tokens = int(THREADPOOL_SIZE)
+
+
+@APP.on_event("startup")
+def create_indexes():
+    """Create missing indexes of the feature tables, if AUTO_INDEX is set."""
+    indexes.auto_index()
+
+
+@APP.on_event("startup")
+def load_columnar():
+    """Load the feature tables into memory, if ICEES_ENGINE is columnar."""
+    columnar.load()
+
+
 @APP.get("/tos", response_class=PlainTextResponse)
 def terms_of_service():
     """Get terms of service."""
@@ -132,6 +153,21 @@ def jsonable_safe(obj):
         return obj
 
 
+def ndjson_lines(results):
+    """Generate newline-delimited JSON, starting with the terms and conditions."""
+    yield to_json({"terms and conditions": TERMS_AND_CONDITIONS}) + b"\n"
+    try:
+        for result in results:
+            yield to_json(result) + b"\n"
+    except fanout.Cancelled:
+        # no one is listening
+        return
+    except Exception as err:
+        # the response has started, so the stream just ends
+        LOGGER.exception(err)
+        raise
+
+
 def prepare_output(func):
     """Prepare output."""
     @wraps(func)
@@ -145,6 +181,10 @@ def prepare_output(func):
         }
 
         # run func, logging errors
+        token = cache.ENDPOINT.set(func.__name__)
+        disconnected_token = fanout.DISCONNECTED.set(
+            lambda: from_thread.run(request.is_disconnected)
+        )
         try:
             return_value = func(*args, **kwargs)
 
@@ -156,6 +196,16 @@ def prepare_output(func):
         except Exception as err:
             LOGGER.exception(err)
             return_value = {"return value": str(err)}
+        finally:
+            cache.ENDPOINT.reset(token)
+            fanout.DISCONNECTED.reset(disconnected_token)
+
+        # stream results as they are computed, if the handler returns an iterator
+        if isinstance(return_value.get("return value"), Iterator):
+            return StreamingResponse(
+                ndjson_lines(return_value["return value"]),
+                media_type=NDJSON,
+            )
 
         # return tabular data, if requested
         if request.headers["accept"] == "text/tabular":
@@ -169,10 +219,11 @@ def prepare_output(func):
             )
 
         # add terms and conditions
-        return {
+        # returning a response skips FastAPI's jsonable_encoder pass
+        return NaNResponse({
             "terms and conditions": TERMS_AND_CONDITIONS,
             **return_value,
-        }
+        })
 
     # add `request` to function signature
     # without this, FastAPI will not send it
@@ -2,11 +2,18 @@
 from contextlib import contextmanager
 import os
 from pathlib import Path
+from threading import Lock
+from weakref import WeakKeyDictionary
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, MetaData
 from sqlalchemy.engine import Connection
 
 db = os.environ.get("ICEES_DB", "sqlite")
+# identifies the loaded data; change it whenever the data are reloaded
+DATA_VERSION = os.environ.get("ICEES_DATA_VERSION", "")
+# number of compiled statements (and, with SQLite, prepared statements)
+# kept per engine
+QUERY_CACHE_SIZE = int(os.environ.get("QUERY_CACHE_SIZE", "500"))
 
 engine = None
 
@@ -18,7 +25,9 @@ def get_db_connection():
         if db == "sqlite":
             DB_PATH = Path(os.environ["DB_PATH"])
             engine = create_engine(
-                f"sqlite:///{DB_PATH}?check_same_thread=False",
+                f"sqlite:///{DB_PATH}?check_same_thread=False"
+                f"&cached_statements={QUERY_CACHE_SIZE}",
+                query_cache_size=QUERY_CACHE_SIZE,
             )
         elif db == "postgres":
             serv_host = os.environ["ICEES_HOST"]
@@ -27,6 +36,7 @@ def get_db_connection():
                 f"postgresql+psycopg2://icees_dbuser:icees_dbpass@{serv_host}:{serv_port}/icees_database",
                 pool_size=int(os.environ["POOL_SIZE"]),
                 max_overflow=int(os.environ["MAX_OVERFLOW"]),
+                query_cache_size=QUERY_CACHE_SIZE,
             )
         else:
             raise ValueError(f"Unsupported database '{db}'")
@@ -34,6 +44,42 @@ def get_db_connection():
     return engine
 
 
+class MetadataRegistry():
+    """Process-wide registry of reflected table metadata.
+
+    Reflection runs once per engine, on first use, and is shared by all
+    requests until it is explicitly refreshed.
+    """
+
+    def __init__(self):
+        """Initialize."""
+        self._tables = WeakKeyDictionary()
+        self._lock = Lock()
+
+    def get(self, conn: Connection):
+        """Get reflected tables, reflecting them on first use."""
+        with self._lock:
+            tables = self._tables.get(conn.engine)
+            if tables is None:
+                tables = self._reflect(conn)
+            return tables
+
+    def refresh(self, conn: Connection):
+        """Reflect the tables again, e.g. after a schema change."""
+        with self._lock:
+            return self._reflect(conn)
+
+    def _reflect(self, conn: Connection):
+        """Reflect tables and store them by engine."""
+        metadata = MetaData()
+        metadata.reflect(bind=conn)
+        self._tables[conn.engine] = metadata.tables
+        return metadata.tables
+
+
+METADATA = MetadataRegistry()
+
+
 @contextmanager
 def DBConnection() -> Connection:
     """Database connection."""
@@ -1,7 +1,6 @@
 """FastAPI dependencies."""
-from sqlalchemy.ext.automap import automap_base
-
-from .db import DBConnection, Connection
+from .db import DBConnection, Connection, METADATA
+from .features import schema
 
 
 class ConnectionWithTables():
@@ -16,11 +15,19 @@ class ConnectionWithTables():
         """Execute query."""
         return self.connection.execute(*args, **kwargs)
 
+    def refresh_tables(self):
+        """Reflect the tables again and update the shared registry."""
+        self.tables = METADATA.refresh(self.connection)
+        return self.tables
+
+
+def get_db() -> ConnectionWithTables:
+    """Get database connection.
 
-async def get_db() -> ConnectionWithTables:
-    """Get database connection."""
+    This is a plain generator, so FastAPI opens the connection and
+    reflects the tables in its thread pool instead of on the event loop.
+    """
     with DBConnection() as conn:
-        Base = automap_base()
-        Base.prepare(conn.engine, reflect=True)  # reflect the tables
-        tables = Base.metadata.tables
-        yield ConnectionWithTables(conn, tables)
+        conn = ConnectionWithTables(conn, METADATA.get(conn))
+        schema.migrate(conn)
+        yield conn
@@ -0,0 +1,76 @@
+"""Packed bitmaps of table rows."""
+import numpy as np
+
+# number of bits set in each byte
+POPCOUNT = np.array([bin(byte).count("1") for byte in range(256)], dtype=np.uint8)
+
+
+class Bitmap():
+    """Set of row numbers, packed eight rows to a byte.
+
+    Bits past the last row are always clear, so counts need no masking.
+    """
+
+    __slots__ = ("bits", "size")
+
+    def __init__(self, bits, size):
+        """Initialize."""
+        self.bits = bits
+        self.size = size
+
+    @classmethod
+    def from_mask(cls, mask):
+        """Pack a boolean mask of rows."""
+        return cls(np.packbits(mask), len(mask))
+
+    @classmethod
+    def zeros(cls, size):
+        """Get the empty set of `size` rows."""
+        return cls(np.zeros((size + 7) // 8, dtype=np.uint8), size)
+
+    @classmethod
+    def ones(cls, size):
+        """Get the set of all `size` rows."""
+        return cls.from_mask(np.ones(size, dtype=bool))
+
+    def __and__(self, other):
+        """Intersect."""
+        return Bitmap(self.bits & other.bits, self.size)
+
+    def __or__(self, other):
+        """Unite."""
+        return Bitmap(self.bits | other.bits, self.size)
+
+    def __ior__(self, other):
+        """Unite in place."""
+        self.bits |= other.bits
+        return self
+
+    def __iand__(self, other):
+        """Intersect in place."""
+        self.bits &= other.bits
+        return self
+
+    def copy(self):
+        """Copy."""
+        return Bitmap(self.bits.copy(), self.size)
+
+    def count(self):
+        """Count the rows in the set."""
+        return int(POPCOUNT[self.bits].sum(dtype=np.int64))
+
+    def to_mask(self):
+        """Unpack to a boolean mask of rows."""
+        return np.unpackbits(self.bits, count=self.size).astype(bool)
+
+
+def index_column(codes, n_values):
+    """Build a bitmap of the rows of each value of a dictionary-encoded column."""
+    order = np.argsort(codes, kind="stable")
+    bounds = np.searchsorted(codes[order], np.arange(n_values + 1))
+    bitmaps = []
+    for code in range(n_values):
+        mask = np.zeros(len(codes), dtype=bool)
+        mask[order[bounds[code]:bounds[code + 1]]] = True
+        bitmaps.append(Bitmap.from_mask(mask))
+    return bitmaps
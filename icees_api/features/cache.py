@@ -0,0 +1,226 @@
+"""Two-tier cache of query results: in-process LRU, then Redis."""
+from collections import Counter, OrderedDict, defaultdict
+from contextvars import ContextVar
+from functools import wraps
+import json
+import logging
+import os
+from threading import Lock
+import time
+
+import redis
+
+from ..db import DATA_VERSION
+
+logger = logging.getLogger(__name__)
+
+REDIS_HOST = os.environ.get("REDIS_HOST", "localhost")
+REDIS_PORT = int(os.environ.get("REDIS_PORT", "6379"))
+RESULT_CACHE = os.environ.get("RESULT_CACHE", "false").lower() == "true"
+# seconds; 0 keeps results until the data version changes
+RESULT_CACHE_TTL = int(os.environ.get("RESULT_CACHE_TTL", "86400"))
+# seconds to wait before trying an unreachable Redis again
+REDIS_RETRY_INTERVAL = float(os.environ.get("REDIS_RETRY_INTERVAL", "30"))
+# bytes of JSON held by each process's in-memory tier
+LOCAL_CACHE_BYTES = int(os.environ.get("LOCAL_CACHE_BYTES", str(64 * 1024 * 1024)))
+# seconds; bounds how stale another process's entries can get
+LOCAL_CACHE_TTL = float(os.environ.get("LOCAL_CACHE_TTL", "60"))
+
+# name of the endpoint being served, for the cache statistics
+ENDPOINT = ContextVar("endpoint", default=None)
+
+r = redis.Redis(
+    host=REDIS_HOST,
+    port=REDIS_PORT,
+    socket_connect_timeout=1,
+    socket_timeout=1,
+)
+_unavailable_until = 0.0
+
+
+class CacheStats():
+    """Hit, miss and eviction counters per cache tier and endpoint."""
+
+    def __init__(self):
+        """Initialize."""
+        self._counters = defaultdict(Counter)
+        self._lock = Lock()
+
+    def record(self, tier, event):
+        """Count an event of a tier for the current endpoint."""
+        with self._lock:
+            self._counters[tier, ENDPOINT.get()][event] += 1
+
+    def as_list(self):
+        """Get the counters as a list of records."""
+        with self._lock:
+            return [
+                {
+                    "tier": tier,
+                    "endpoint": endpoint,
+                    "hits": counter["hits"],
+                    "misses": counter["misses"],
+                    "evictions": counter["evictions"],
+                }
+                for (tier, endpoint), counter in sorted(
+                    self._counters.items(),
+                    key=lambda item: (item[0][0], str(item[0][1])),
+                )
+            ]
+
+
+STATS = CacheStats()
+
+
+class LRUCache():
+    """Thread-safe LRU cache bounded by the total size of its entries.
+
+    Entries expire after `ttl` seconds, since other processes do not
+    invalidate them.
+    """
+
+    def __init__(self, maxsize, ttl):
+        """Initialize."""
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        """Get a value, or None if it is absent or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, size, expires = entry
+            if time.monotonic() >= expires:
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, size):
+        """Set a value, evicting the least recently used entries."""
+        if size > self.maxsize:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, time.monotonic() + self.ttl)
+            self.size += size
+            while self.size > self.maxsize:
+                self._remove(next(iter(self._entries)))
+                STATS.record("local", "evictions")
+
+    def delete(self, key):
+        """Delete a value."""
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self):
+        """Delete all values."""
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _remove(self, key):
+        """Remove an entry; the lock must be held."""
+        _, size, _ = self._entries.pop(key)
+        self.size -= size
+
+
+LOCAL = LRUCache(LOCAL_CACHE_BYTES, LOCAL_CACHE_TTL)
+
+
+def cache_key(name, digest):
+    """Build the Redis key of a result.
+
+    Keys are namespaced by data version, so reloading the data and
+    changing ICEES_DATA_VERSION invalidates every cached result.
+    """
+    return f"icees:{DATA_VERSION}:{name}:{digest.hex()}"
+
+
+def _call_redis(method, *args, **kwargs):
+    """Call Redis, returning None if it is unreachable.
+
+    After a failure, Redis is skipped for REDIS_RETRY_INTERVAL seconds so
+    that requests do not each wait on a connection timeout.
+    """
+    global _unavailable_until
+    if not redis_available():
+        return None
+    try:
+        return getattr(r, method)(*args, **kwargs)
+    except redis.RedisError as err:
+        logger.warning("Redis unavailable, not caching results: %s", err)
+        _unavailable_until = time.monotonic() + REDIS_RETRY_INTERVAL
+        return None
+
+
+def redis_available():
+    """Determine whether Redis is worth trying."""
+    return time.monotonic() >= _unavailable_until
+
+
+def cached(key, ttl=None, load=lambda result: result, local=False):
+    """Generate a decorator to cache results in Redis.
+
+    `key` maps the function's arguments to a digest (see get_digest) of
+    everything the result depends on; it must not depend on the
+    connection. Results are stored as JSON, and `load` restores anything
+    JSON does not round-trip. None results are not cached.
+
+    With `local`, results are also kept in this process's LRU tier, which
+    is checked before Redis. Callers must not modify those results.
+
+    The decorated function gets an `invalidate` method, taking the same
+    arguments, that deletes the cached result from both tiers.
+    """
+    def decorator(func):
+        """Decorate a function to cache results."""
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not RESULT_CACHE:
+                return func(*args, **kwargs)
+            key_ = cache_key(func.__name__, key(*args, **kwargs))
+            if local:
+                result = LOCAL.get(key_)
+                STATS.record("local", "misses" if result is None else "hits")
+                if result is not None:
+                    return result
+            if redis_available():
+                cached_result = _call_redis("get", key_)
+                STATS.record("redis", "misses" if cached_result is None else "hits")
+                if cached_result is not None:
+                    result = load(json.loads(cached_result))
+                    if local:
+                        LOCAL.set(key_, result, len(cached_result))
+                    return result
+            result = func(*args, **kwargs)
+            if result is None:
+                return result
+            try:
+                value = json.dumps(result)
+            except TypeError:
+                logger.warning("Result of %s is not JSON-serializable", func.__name__)
+                return result
+            ttl_ = RESULT_CACHE_TTL if ttl is None else ttl
+            _call_redis("set", key_, value, ex=ttl_ or None)
+            if local:
+                LOCAL.set(key_, result, len(value))
+            return result
+
+        def invalidate(*args, **kwargs):
+            """Delete the cached result of these arguments."""
+            if not RESULT_CACHE:
+                return
+            key_ = cache_key(func.__name__, key(*args, **kwargs))
+            LOCAL.delete(key_)
+            _call_redis("delete", key_)
+
+        wrapper.invalidate = invalidate
+        return wrapper
+    return decorator
@@ -0,0 +1,421 @@
+"""Columnar in-memory copies of the feature tables.
+
+With ICEES_ENGINE=columnar, the patient and visit tables are loaded into
+memory, each column dictionary-encoded as a NumPy array of codes into its
+distinct values. Columns that queries filter or group on are also indexed
+by a bitmap of the rows of each value, so that cohorts are ANDs and ORs of
+bitmaps and counts are popcounts of their intersections. Counts are thus
+computed without querying the database. Anything that cannot be answered
+exactly as the database would answer it raises Unsupported, and the
+caller falls back to SQL.
+"""
+from collections import Counter, defaultdict, namedtuple
+from decimal import Decimal
+import logging
+import os
+from threading import Lock
+from weakref import WeakKeyDictionary
+
+import numpy as np
+import pandas as pd
+from sqlalchemy.sql import select
+
+from ..db import DBConnection, METADATA
+from ..dependencies import ConnectionWithTables
+from .bitmaps import Bitmap, index_column
+
+logger = logging.getLogger(__name__)
+
+# "sql" queries the database; "columnar" counts in memory where it can
+ICEES_ENGINE = os.environ.get("ICEES_ENGINE", "sql")
+ENABLED = ICEES_ENGINE == "columnar"
+TABLES = ("patient", "visit")
+FETCH_SIZE = int(os.environ.get("FETCH_SIZE", "10000"))
+PRIMARY_KEY = "PatientId"
+ORDERED_OPERATORS = (">", "<", ">=", "<=", "between")
+# most combinations of values to count by intersecting bitmaps; past this,
+# rows are grouped by their codes instead
+MAX_BITMAP_CELLS = int(os.environ.get("MAX_BITMAP_CELLS", "1024"))
+
+# codes index `values`; -1 is NULL. `kind` is "number" or "string" if all
+# non-NULL values are of that kind, None if there are none, else "mixed".
+Column = namedtuple("Column", ["codes", "values", "kind"])
+
+
+class Unsupported(Exception):
+    """The columnar store cannot answer this query; use SQL instead."""
+
+
+def value_kind(value):
+    """Classify a value as a number or a string."""
+    if isinstance(value, (int, float, Decimal)) and not isinstance(value, bool):
+        return "number"
+    if isinstance(value, str):
+        return "string"
+    return "other"
+
+
+def coerce(kind, dialect, operand, opr):
+    """Convert an operand as the database would to compare it to a column.
+
+    `kind` is the kind of the column's values. Numeric strings are
+    compared to numeric columns as numbers, and SQLite compares integers to
+    text columns as text. Other mixes of types, and ordered comparisons of
+    text outside SQLite (which depend on the collation), are unsupported.
+    """
+    operand_kind = value_kind(operand)
+    if kind is None or kind == operand_kind == "number":
+        return operand
+    if kind == "number" and operand_kind == "string":
+        try:
+            number = float(operand)
+        except ValueError:
+            raise Unsupported(f"Cannot compare numbers to '{operand}'")
+        return int(number) if number.is_integer() else number
+    if kind == "string" and dialect == "sqlite":
+        if operand_kind == "string":
+            return operand
+        if isinstance(operand, int) and not isinstance(operand, bool):
+            return str(operand)
+    if kind == "string" and operand_kind == "string" and opr not in ORDERED_OPERATORS:
+        return operand
+    raise Unsupported(f"Cannot compare {kind} column to {operand!r}")
+
+
+def smallest_code_type(n_values):
+    """Get the smallest signed integer type holding codes -1 to n_values - 1."""
+    for dtype in (np.int8, np.int16, np.int32):
+        if n_values <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+
+class ColumnarTable():
+    """Dictionary-encoded columns of a table, with bitmap indexes.
+
+    Bitmap indexes are built for each column on first use and kept, at a
+    bit per row for each distinct value of the column.
+    """
+
+    def __init__(self, columns, n_rows, dialect):
+        """Initialize."""
+        self.columns = columns
+        self.n_rows = n_rows
+        self.dialect = dialect
+        self._bitmaps = {}
+        # if each patient has at most one row per year, cohort sizes are
+        # the counts of matching rows
+        self.unique_patient_years = False
+        if PRIMARY_KEY in columns and "year" in columns:
+            patients = columns[PRIMARY_KEY].codes.astype(np.int64)
+            years = columns["year"].codes.astype(np.int64) + 1
+            self.unique_patient_years = bool(np.all(patients >= 0)) and len(np.unique(
+                patients * (len(columns["year"].values) + 1) + years
+            )) == n_rows
+
+    @classmethod
+    def load(cls, conn, table_):
+        """Read a table, encoding its columns a chunk of rows at a time."""
+        names = list(table_.columns.keys())
+        encoders = [{} for _ in names]
+        chunks = [[] for _ in names]
+        n_rows = 0
+        result = conn.execute(select([table_]))
+        while rows := result.fetchmany(FETCH_SIZE):
+            n_rows += len(rows)
+            for encoder, chunk, values in zip(encoders, chunks, zip(*rows)):
+                codes, uniques = pd.factorize(np.array(values, dtype=object))
+                mapping = np.array(
+                    [encoder.setdefault(value, len(encoder)) for value in uniques],
+                    dtype=np.int64,
+                )
+                chunk.append(np.where(codes >= 0, mapping[codes] if len(mapping) else -1, -1))
+        columns = {}
+        for name, encoder, chunk in zip(names, encoders, chunks):
+            values = np.empty(len(encoder), dtype=object)
+            values[:] = list(encoder)
+            kinds = {value_kind(value) for value in values}
+            codes = np.concatenate(chunk) if chunk else np.empty(0, dtype=np.int64)
+            columns[name] = Column(
+                codes.astype(smallest_code_type(len(values))),
+                values,
+                kinds.pop() if len(kinds) == 1 else ("mixed" if kinds else None),
+            )
+        logger.info("Loaded %d rows of %s into memory", n_rows, table_.name)
+        return cls(columns, n_rows, conn.connection.engine.dialect.name)
+
+    def column(self, name):
+        """Get a column, or raise Unsupported if there is none of the name."""
+        try:
+            return self.columns[name]
+        except KeyError:
+            raise Unsupported(f"No column named '{name}'")
+
+    def bitmaps(self, name):
+        """Get the bitmap of the rows of each value of a column."""
+        bitmaps = self._bitmaps.get(name)
+        if bitmaps is None:
+            column_ = self.column(name)
+            bitmaps = self._bitmaps[name] = index_column(column_.codes, len(column_.values))
+        return bitmaps
+
+    def coerce(self, column_, operand, opr):
+        """Convert an operand as the database would to compare it to a column."""
+        return coerce(column_.kind, self.dialect, operand, opr)
+
+    def predicate(self, feature_name, qualifier):
+        """Get the rows satisfying a feature qualifier (see op_dict).
+
+        The result is the union of the bitmaps of the satisfying values;
+        NULL satisfies nothing.
+        """
+        from .sql import simplify_value
+
+        column_ = self.column(feature_name)
+        opr = qualifier["operator"]
+
+        def operand(value):
+            """Simplify and coerce an operand."""
+            return self.coerce(column_, simplify_value(value, opr), opr)
+
+        if opr == "between":
+            low, high = operand(qualifier["value_a"]), operand(qualifier["value_b"])
+            test = lambda value: low <= value <= high
+        elif opr == "in":
+            values = {operand(value) for value in qualifier["values"]}
+            test = lambda value: value in values
+        elif opr in ("=", "<>", ">", "<", ">=", "<="):
+            compare = {
+                "=": lambda a, b: a == b,
+                "<>": lambda a, b: a != b,
+                ">": lambda a, b: a > b,
+                "<": lambda a, b: a < b,
+                ">=": lambda a, b: a >= b,
+                "<=": lambda a, b: a <= b,
+            }[opr]
+            value_ = operand(qualifier["value"])
+            test = lambda value: compare(value, value_)
+        else:
+            raise Unsupported(f"Unsupported operator '{opr}'")
+        mask = Bitmap.zeros(self.n_rows)
+        for value, bitmap in zip(column_.values, self.bitmaps(feature_name)):
+            if test(value):
+                mask |= bitmap
+        return mask
+
+    def cohort_mask(self, cohort_features):
+        """Get the rows satisfying every feature, whatever its year."""
+        mask = Bitmap.ones(self.n_rows)
+        for feature in cohort_features:
+            mask &= self.predicate(feature["feature_name"], feature["feature_qualifier"])
+        return mask
+
+    def year_mask(self, year):
+        """Get the rows of a year."""
+        return self.predicate("year", {"operator": "=", "value": year})
+
+    def patient_counts(self, mask):
+        """Count the rows of each patient in a bitmap.
+
+        Index 0 is for rows without a patient, which match no patient.
+        """
+        codes = self.column(PRIMARY_KEY).codes
+        counts = np.bincount(
+            codes[mask.to_mask()].astype(np.int64) + 1,
+            minlength=len(self.columns[PRIMARY_KEY].values) + 1,
+        )
+        counts[0] = 0
+        return counts
+
+    def patient_weights(self, base, cohort_features_norm, cohort_year):
+        """Get the rows joined to each patient by the cohort's feature groups.
+
+        As in generate_tables_from_features, the features are grouped by
+        year and each group's matching rows are joined on PatientId, so each
+        patient stands for the product of its rows in each group.
+        """
+        weights = None
+        for year, features in feature_groups(cohort_features_norm, cohort_year).items():
+            mask = base & self.cohort_mask(features)
+            if year is not None:
+                mask &= self.year_mask(year)
+            counts = self.patient_counts(mask)
+            weights = counts if weights is None else weights * counts
+        return weights
+
+    def count_patients(self, cohort_features_norm, cohort_year):
+        """Count the distinct patients of a cohort."""
+        groups = feature_groups(cohort_features_norm, cohort_year)
+        if len(groups) == 1 and self.unique_patient_years:
+            [(year, features)] = groups.items()
+            if year is not None:
+                return (self.cohort_mask(features) & self.year_mask(year)).count()
+        weights = self.patient_weights(Bitmap.ones(self.n_rows), cohort_features_norm, cohort_year)
+        return int(np.count_nonzero(weights))
+
+    def group_counts(self, mask, names):
+        """Count each combination of non-NULL values of columns in a bitmap.
+
+        With few enough combinations, each is counted by intersecting
+        bitmaps, skipping combinations whose prefix has no rows.
+        """
+        columns = [self.column(name) for name in names]
+        cells = np.prod([float(len(column_.values)) for column_ in columns])
+        if cells <= MAX_BITMAP_CELLS:
+            return self._intersect_counts(mask, names, [])
+        mask = mask.to_mask()
+        codes = [column_.codes[mask].astype(np.int64) for column_ in columns]
+        valid = np.ones(len(codes[0]) if codes else 0, dtype=bool)
+        for codes_ in codes:
+            valid &= codes_ >= 0
+        codes = [codes_[valid] for codes_ in codes]
+        sizes = [max(len(column_.values), 1) for column_ in columns]
+        if np.prod(np.array(sizes, dtype=float)) < 2 ** 62:
+            combined = np.zeros(len(codes[0]), dtype=np.int64)
+            for codes_, size in zip(codes, sizes):
+                combined = combined * size + codes_
+            combinations, counts = np.unique(combined, return_counts=True)
+            rows = []
+            for combination, count in zip(combinations.tolist(), counts.tolist()):
+                row = []
+                for size in reversed(sizes):
+                    combination, code = divmod(combination, size)
+                    row.append(code)
+                rows.append((row[::-1], count))
+        else:
+            combinations, counts = np.unique(np.stack(codes, axis=1), axis=0, return_counts=True)
+            rows = zip(combinations.tolist(), counts.tolist())
+        return [
+            [*(column_.values[code] for column_, code in zip(columns, row)), count]
+            for row, count in rows
+        ]
+
+    def _intersect_counts(self, mask, names, prefix):
+        """Count the combinations of values of columns, after a prefix."""
+        rows = []
+        for value, bitmap in zip(self.column(names[0]).values, self.bitmaps(names[0])):
+            mask_ = mask & bitmap
+            count = mask_.count()
+            if not count:
+                continue
+            if len(names) == 1:
+                rows.append([*prefix, value, count])
+            else:
+                rows.extend(self._intersect_counts(mask_, names[1:], [*prefix, value]))
+        return rows
+
+    def code_counts(self, name, rows, weights):
+        """Count the (weighted) codes of a column in rows, NULLs (-1) included.
+
+        Codes are ordered by their first row, as a scan would find them.
+        """
+        keep = weights > 0
+        codes = self.column(name).codes[rows][keep].astype(np.int64)
+        totals = np.bincount(codes + 1, weights=weights[keep], minlength=len(self.columns[name].values) + 1)
+        found, first = np.unique(codes, return_index=True)
+        found = found[np.argsort(first)]
+        return found, np.rint(totals[found + 1]).astype(np.int64)
+
+    def value_counts(self, name, rows, weights):
+        """Count the (weighted) values of a column in rows, NULLs included."""
+        values = self.column(name).values
+        codes, counts = self.code_counts(name, rows, weights)
+        return Counter({
+            (None if code < 0 else values[code]): count
+            for code, count in zip(codes.tolist(), counts.tolist())
+        })
+
+
+def feature_groups(cohort_features_norm, cohort_year):
+    """Group cohort features by year, as generate_tables_from_features does."""
+    groups = defaultdict(list)
+    for feature in cohort_features_norm:
+        groups[feature["year"]].append(feature)
+    if not groups:
+        groups[cohort_year] = []
+    return groups
+
+
+class ColumnarStore():
+    """Process-wide registry of in-memory tables, loaded once per engine."""
+
+    def __init__(self):
+        """Initialize."""
+        self._tables = WeakKeyDictionary()
+        self._lock = Lock()
+
+    def get(self, conn, table_name):
+        """Get an in-memory table, loading it on first use."""
+        if table_name not in TABLES or table_name not in conn.tables:
+            raise Unsupported(f"Table '{table_name}' is not held in memory")
+        engine = conn.connection.engine
+        with self._lock:
+            tables = self._tables.setdefault(engine, {})
+            if table_name not in tables:
+                tables[table_name] = ColumnarTable.load(conn, conn.tables[table_name])
+            return tables[table_name]
+
+    def clear(self, conn):
+        """Drop the tables of an engine, so they are loaded again."""
+        with self._lock:
+            self._tables.pop(conn.connection.engine, None)
+
+
+STORE = ColumnarStore()
+
+
+def load():
+    """Load the feature tables into memory, if the columnar engine is enabled."""
+    if not ENABLED:
+        return
+    with DBConnection() as conn:
+        conn = ConnectionWithTables(conn, METADATA.get(conn))
+        for table_name in TABLES:
+            if table_name in conn.tables:
+                STORE.get(conn, table_name)
+
+
+def count_unique(conn, table_name, year, columns, cohort_features_norm):
+    """Count each unique combination of column values (see sql.count_unique)."""
+    table_ = STORE.get(conn, table_name)
+    mask = table_.cohort_mask(cohort_features_norm)
+    if year:
+        mask &= table_.year_mask(year)
+    return table_.group_counts(mask, columns)
+
+
+def count_unique_pairs(conn, table_name, year, column_a, columns_b, cohort_features_norm):
+    """Count unique pairs of values (see sql.count_unique_pairs)."""
+    table_ = STORE.get(conn, table_name)
+    mask = table_.cohort_mask(cohort_features_norm)
+    if year:
+        mask &= table_.year_mask(year)
+    return {
+        column_b: table_.group_counts(mask, [column_a, column_b])
+        for column_b in columns_b
+    }
+
+
+def count_values(conn, table_name, year, cohort_features_norm, cohort_year, feature_names):
+    """Count the values of features in a cohort (see sql.count_values).
+
+    `cohort_year` applies only if there are no cohort features.
+    """
+    table_ = STORE.get(conn, table_name)
+    base = table_.cohort_mask(cohort_features_norm)
+    weights = table_.patient_weights(base, cohort_features_norm, cohort_year)
+    rows = base.copy()
+    if year is not None:
+        rows &= table_.year_mask(year)
+    rows = np.flatnonzero(rows.to_mask())
+    row_weights = weights[table_.column(PRIMARY_KEY).codes[rows].astype(np.int64) + 1]
+    return {
+        feature_name: table_.value_counts(feature_name, rows, row_weights)
+        for feature_name in feature_names
+    }
+
+
+def count_cohort(conn, table_name, year, cohort_features_norm):
+    """Count the distinct patients of a cohort (see sql.select_cohort)."""
+    table_ = STORE.get(conn, table_name)
+    return table_.count_patients(cohort_features_norm, year)
@@ -0,0 +1,339 @@
+"""Precomputed counts of feature values and of pairs of them.
+
+An offline job, `python -m icees_api.features.cube`, counts the values of
+each feature of a table, and each pair of values of each pair of
+features, for each year and for all years together. For the unfiltered
+cohort, these are the results of count_values and of
+count_unique(conn, table, year, a, b). Those functions then answer from
+these counts without querying the database: count_values for the
+unfiltered cohort, and count_unique for it and for cohorts defined by one
+equality on one of the two features.
+
+Counts are stored per table in `<CUBE_PATH>/<table>.cube`, a memory-mapped
+file (see mapped) shared by every process that uses it. They record the
+data version they were computed from, and are ignored once the data
+version changes, until the job is run again.
+"""
+import argparse
+from collections import Counter
+import json
+import logging
+import os
+from pathlib import Path
+from threading import Lock
+
+import numpy as np
+
+from ..db import DATA_VERSION, DBConnection, METADATA
+from ..dependencies import ConnectionWithTables
+from . import mapped
+from .bitmaps import Bitmap
+from .columnar import ColumnarTable, PRIMARY_KEY, Unsupported, coerce
+
+logger = logging.getLogger(__name__)
+
+# directory of the cube files; unset disables the cube
+CUBE_PATH = os.environ.get("CUBE_PATH")
+TABLES = ("patient", "visit")
+# how value counts are weighted: by the rows of each patient in the counted
+# year, i.e. for a cohort of that year, or in all years, for a cohort of
+# all years (see count_values)
+SAME_YEAR, ALL_YEARS = 0, 1
+
+
+def pair_index(i, j, n_features):
+    """Index the pair of features i <= j among all such pairs."""
+    return i * n_features - i * (i - 1) // 2 + (j - i)
+
+
+def build_cube(conn, table_name, path):
+    """Count the values and pairs of values of each feature, and save them.
+
+    Features whose values JSON cannot store are left out.
+    """
+    table_ = ColumnarTable.load(conn, conn.tables[table_name])
+    features = []
+    values = []
+    for name, column_ in table_.columns.items():
+        if name.lower() in (table_name.lower() + "id", "year"):
+            continue
+        try:
+            values.append(json.dumps(column_.values.tolist()).encode("utf-8"))
+        except TypeError:
+            logger.warning("Cannot store values of %s in the cube", name)
+            continue
+        features.append(name)
+    years = [None]
+    if "year" in table_.columns:
+        years.extend(table_.columns["year"].values.tolist())
+    histograms = PRIMARY_KEY in table_.columns
+
+    n_features = len(features)
+    n_pairs = pair_index(n_features - 1, n_features - 1, n_features) + 1 if features else 0
+    offsets = np.zeros((len(years), n_pairs + 1), dtype=np.int64)
+    codes_a, codes_b, counts = [], [], []
+    total = 0
+    hist_offsets = np.zeros((2, len(years), n_features + 1), dtype=np.int64)
+    hist_codes, hist_counts = [], []
+    hist_total = 0
+    if histograms:
+        patients = table_.columns[PRIMARY_KEY].codes.astype(np.int64) + 1
+        patient_rows = table_.patient_counts(Bitmap.ones(table_.n_rows))
+    for year_index, year in enumerate(years):
+        mask = np.ones(table_.n_rows, dtype=bool)
+        if year is not None:
+            mask = table_.columns["year"].codes == year_index - 1
+        codes = [table_.columns[name].codes[mask].astype(np.int64) for name in features]
+        sizes = [len(table_.columns[name].values) for name in features]
+        for i in range(n_features):
+            for j in range(i, n_features):
+                valid = (codes[i] >= 0) & (codes[j] >= 0)
+                pair_counts = np.bincount(
+                    codes[i][valid] * sizes[j] + codes[j][valid],
+                    minlength=sizes[i] * sizes[j],
+                )
+                cells = np.flatnonzero(pair_counts)
+                codes_a.append(cells // max(sizes[j], 1))
+                codes_b.append(cells % max(sizes[j], 1))
+                counts.append(pair_counts[cells])
+                offsets[year_index, pair_index(i, j, n_features)] = total
+                total += len(cells)
+        offsets[year_index, n_pairs] = total
+
+        if not histograms:
+            continue
+        rows = np.flatnonzero(mask)
+        for weighting, weights in [
+                (SAME_YEAR, table_.patient_counts(Bitmap.from_mask(mask))),
+                (ALL_YEARS, patient_rows),
+        ]:
+            for i, name in enumerate(features):
+                hist_offsets[weighting, year_index, i] = hist_total
+                codes_, counts_ = table_.code_counts(name, rows, weights[patients[rows]])
+                hist_codes.append(codes_)
+                hist_counts.append(counts_)
+                hist_total += len(codes_)
+            hist_offsets[weighting, year_index, n_features] = hist_total
+
+    meta = {
+        "data_version": DATA_VERSION,
+        "dialect": table_.dialect,
+        "years": years,
+        "year_kind": table_.columns["year"].kind if "year" in table_.columns else None,
+        "features": features,
+        "kinds": [table_.columns[name].kind for name in features],
+        "histograms": histograms,
+    }
+    mapped.save(path, meta, {
+        "offsets": offsets,
+        "codes_a": np.concatenate(codes_a or [[]]).astype(np.int32),
+        "codes_b": np.concatenate(codes_b or [[]]).astype(np.int32),
+        "counts": np.concatenate(counts or [[]]).astype(np.int64),
+        "hist_offsets": hist_offsets,
+        "hist_codes": np.concatenate(hist_codes or [[]]).astype(np.int32),
+        "hist_counts": np.concatenate(hist_counts or [[]]).astype(np.int64),
+        "value_offsets": np.cumsum([0, *map(len, values)]).astype(np.int64),
+        "values": np.frombuffer(b"".join(values), dtype=np.uint8),
+    })
+    logger.info("Saved %d counts of %d feature pairs of %s to %s", total, n_pairs, table_name, path)
+
+
+class Cube():
+    """Counts of a table, mapped from a cube file.
+
+    The values of each feature are decoded on first use.
+    """
+
+    def __init__(self, path):
+        """Map."""
+        meta, self.arrays = mapped.load(path)
+        self.data_version = meta["data_version"]
+        self.dialect = meta["dialect"]
+        self.years = {year: index for index, year in enumerate(meta["years"])}
+        self.year_kind = meta["year_kind"]
+        self.features = {name: index for index, name in enumerate(meta["features"])}
+        self.kinds = meta["kinds"]
+        self.histograms = meta["histograms"]
+        self._values = {}
+
+    def feature(self, name):
+        """Get the index of a feature."""
+        try:
+            return self.features[name]
+        except KeyError:
+            raise Unsupported(f"No feature named '{name}' in the cube")
+
+    def values(self, index):
+        """Get the values of a feature, by code."""
+        values = self._values.get(index)
+        if values is None:
+            start, end = self.arrays["value_offsets"][index:index + 2]
+            values = self._values[index] = json.loads(self.arrays["values"][start:end].tobytes())
+        return values
+
+    def year_index(self, year):
+        """Get the index of a year, or of all years for None."""
+        if year is not None:
+            year = coerce(self.year_kind, self.dialect, year, "=")
+        try:
+            return self.years[year]
+        except KeyError:
+            raise Unsupported(f"No year {year!r} in the cube")
+
+    def pair_counts(self, year, feature_a, feature_b):
+        """Get the codes of each value pair of two features, and their counts."""
+        year_index = self.year_index(year or None)
+        i, j = self.feature(feature_a), self.feature(feature_b)
+        swap = i > j
+        if swap:
+            i, j = j, i
+        index = pair_index(i, j, len(self.features))
+        start, end = self.arrays["offsets"][year_index, index:index + 2]
+        codes_a = self.arrays["codes_a"][start:end]
+        codes_b = self.arrays["codes_b"][start:end]
+        if swap:
+            codes_a, codes_b = codes_b, codes_a
+        return codes_a, codes_b, self.arrays["counts"][start:end]
+
+    def count_unique(self, year, columns, cohort_features_norm):
+        """Count each unique combination of the values of one or two features.
+
+        The cohort must be unfiltered, or be one equality on one of them.
+        """
+        if len(columns) not in (1, 2):
+            raise Unsupported("The cube holds pairs of features")
+        feature_a, feature_b = columns[0], columns[-1]
+        codes_a, codes_b, counts = self.pair_counts(year, feature_a, feature_b)
+        if cohort_features_norm:
+            if len(cohort_features_norm) > 1:
+                raise Unsupported("The cube holds cohorts of one feature")
+            [feature] = cohort_features_norm
+            name, qualifier = feature["feature_name"], feature["feature_qualifier"]
+            if name not in columns or qualifier["operator"] != "=":
+                raise Unsupported("The cube holds cohorts of an equality on a counted feature")
+            keep = self.equal(name, qualifier["value"])[
+                codes_a if name == feature_a else codes_b
+            ]
+            codes_a, codes_b, counts = codes_a[keep], codes_b[keep], counts[keep]
+        values_a = self.values(self.features[feature_a])
+        values_b = self.values(self.features[feature_b])
+        if len(columns) == 1:
+            # the pair of a feature with itself has only equal values
+            return [
+                [values_a[code], count]
+                for code, count in zip(codes_a.tolist(), counts.tolist())
+            ]
+        return [
+            [values_a[code_a], values_b[code_b], count]
+            for code_a, code_b, count in zip(codes_a.tolist(), codes_b.tolist(), counts.tolist())
+        ]
+
+    def equal(self, name, value):
+        """Get which values of a feature equal a value, by code."""
+        from .sql import simplify_value
+
+        index = self.feature(name)
+        value = coerce(self.kinds[index], self.dialect, simplify_value(value, "="), "=")
+        return np.array([value_ == value for value_ in self.values(index)], dtype=bool)
+
+    def count_values(self, year, cohort_features_norm, cohort_year, feature_names):
+        """Count the values of features in the unfiltered cohort.
+
+        The cohort must be of all years, or of the counted year.
+        """
+        if cohort_features_norm or not self.histograms:
+            raise Unsupported("The cube holds counts of the unfiltered cohort")
+        year_index = self.year_index(year)
+        if cohort_year is None:
+            weighting = ALL_YEARS
+        elif year is not None and self.year_index(cohort_year) == year_index:
+            weighting = SAME_YEAR
+        else:
+            raise Unsupported("The cube holds cohorts of all years or the counted year")
+        offsets = self.arrays["hist_offsets"][weighting, year_index]
+        counts = {}
+        for feature_name in feature_names:
+            index = self.feature(feature_name)
+            values = self.values(index)
+            start, end = offsets[index:index + 2]
+            counts[feature_name] = Counter({
+                (None if code < 0 else values[code]): count
+                for code, count in zip(
+                    self.arrays["hist_codes"][start:end].tolist(),
+                    self.arrays["hist_counts"][start:end].tolist(),
+                )
+            })
+        return counts
+
+
+_cubes = {}
+_cubes_lock = Lock()
+
+
+def get_cube(table_name):
+    """Get the cube of a table, mapping it on first use.
+
+    Raises Unsupported if there is no cube, or it is out of date.
+    """
+    if CUBE_PATH is None:
+        raise Unsupported("No cube")
+    path = Path(CUBE_PATH) / f"{table_name}.cube"
+    with _cubes_lock:
+        if table_name not in _cubes:
+            cube = None
+            if path.exists():
+                cube = Cube(path)
+                if cube.data_version != DATA_VERSION:
+                    logger.warning(
+                        "Ignoring cube %s of data version %r; rebuild it",
+                        path, cube.data_version,
+                    )
+                    cube = None
+            _cubes[table_name] = cube
+        cube = _cubes[table_name]
+    if cube is None:
+        raise Unsupported(f"No cube of {table_name}")
+    return cube
+
+
+def count_unique(table_name, year, columns, cohort_features_norm):
+    """Count unique value combinations from the cube (see sql.count_unique)."""
+    return get_cube(table_name).count_unique(year, columns, cohort_features_norm)
+
+
+def count_unique_pairs(table_name, year, column_a, columns_b, cohort_features_norm):
+    """Count unique pairs of values from the cube (see sql.count_unique_pairs)."""
+    cube = get_cube(table_name)
+    return {
+        column_b: cube.count_unique(year, [column_a, column_b], cohort_features_norm)
+        for column_b in columns_b
+    }
+
+
+def count_values(table_name, year, cohort_features_norm, cohort_year, feature_names):
+    """Count the values of features from the cube (see sql.count_values)."""
+    return get_cube(table_name).count_values(
+        year, cohort_features_norm, cohort_year, feature_names,
+    )
+
+
+def main(args=None):
+    """Build the cubes of the feature tables."""
+    parser = argparse.ArgumentParser(
+        description="Count the values, and pairs of values, of every feature.",
+    )
+    parser.add_argument("--tables", nargs="+", default=TABLES, help="tables to count")
+    parser.add_argument("--output", default=CUBE_PATH, help="directory of the cube files")
+    args = parser.parse_args(args)
+    if args.output is None:
+        parser.error("set CUBE_PATH or --output")
+
+    with DBConnection() as conn:
+        conn = ConnectionWithTables(conn, METADATA.get(conn))
+        for table_name in args.tables:
+            if table_name in conn.tables:
+                build_cube(conn, table_name, Path(args.output) / f"{table_name}.cube")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""Fan independent queries out across pooled connections."""
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextvars import ContextVar, copy_context
+import os
+from threading import Event, Lock
+
+from ..dependencies import ConnectionWithTables
+
+# connections (and threads) used by each request; 1 runs queries serially
+FANOUT_WORKERS = int(os.environ.get("FANOUT_WORKERS", "1"))
+# threads shared by all requests in the process
+FANOUT_THREADS = int(os.environ.get("FANOUT_THREADS", "16"))
+# seconds between checks that the client is still connected
+DISCONNECT_POLL_INTERVAL = 0.5
+
+# returns True once the client of the current request has gone away;
+# it may only be called from the thread serving the request
+DISCONNECTED = ContextVar("disconnected", default=lambda: False)
+
+_executor = None
+_executor_lock = Lock()
+
+
+class Cancelled(Exception):
+    """The client disconnected, so the work was abandoned."""
+
+
+def get_executor():
+    """Get the process-wide thread pool, creating it on first use."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=FANOUT_THREADS,
+                thread_name_prefix="fanout",
+            )
+        return _executor
+
+
+def workers(conn):
+    """Get the number of connections to fan out across.
+
+    In-memory SQLite databases exist only on their own connection, so
+    queries against them always run serially on it.
+    """
+    url = conn.connection.engine.url
+    if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+        return 1
+    return max(FANOUT_WORKERS, 1)
+
+
+def check_disconnected():
+    """Raise Cancelled if the client of the current request is gone."""
+    if DISCONNECTED.get()():
+        raise Cancelled("client disconnected")
+
+
+def fan_out(conn, func, items):
+    """Compute func(conn, item) for each item, in parallel.
+
+    Up to `workers(conn)` threads each take a connection from the engine's
+    pool and work through the items. Results are returned in the order of
+    the items. If any calls fail, the exception of the first failed item
+    is raised, and the remaining items are not started. Items are not
+    started once the client has disconnected either; Cancelled is raised
+    instead.
+    """
+    items = list(items)
+    n_workers = min(workers(conn), len(items))
+    if n_workers <= 1:
+        results = []
+        for item in items:
+            check_disconnected()
+            results.append(func(conn, item))
+        return results
+
+    results = [None] * len(items)
+    errors = {}
+    stop = Event()
+    queue = iter(enumerate(items))
+    queue_lock = Lock()
+
+    def work():
+        """Compute items on a connection of our own."""
+        with conn.connection.engine.connect() as connection:
+            conn_ = ConnectionWithTables(connection, conn.tables)
+            while not stop.is_set():
+                with queue_lock:
+                    index, item = next(queue, (None, None))
+                if index is None:
+                    return
+                try:
+                    results[index] = func(conn_, item)
+                except Exception as err:
+                    errors[index] = err
+                    stop.set()
+
+    executor = get_executor()
+    futures = [
+        executor.submit(copy_context().run, work)
+        for _ in range(n_workers)
+    ]
+    try:
+        while wait(futures, timeout=DISCONNECT_POLL_INTERVAL).not_done:
+            check_disconnected()
+    except Cancelled:
+        stop.set()
+        raise
+    for future in futures:
+        future.result()
+    if errors:
+        raise errors[min(errors)]
+    return results
@@ -0,0 +1,164 @@
+"""Advise on, and create, indexes of the feature tables.
+
+Run `python -m icees_api.features.indexes` to list the missing indexes,
+and add `--create` to create them.
+"""
+import argparse
+from collections import Counter, namedtuple
+import json
+import logging
+import os
+import re
+
+from sqlalchemy import Index, inspect
+from sqlalchemy.exc import DBAPIError
+
+from ..db import DBConnection, METADATA
+from ..dependencies import ConnectionWithTables
+from .sql import get_digest
+
+logger = logging.getLogger(__name__)
+
+TABLES = ("patient", "visit")
+# features used in at least this many cohort definitions get an index
+INDEX_MIN_COHORTS = int(os.environ.get("INDEX_MIN_COHORTS", "10"))
+AUTO_INDEX = os.environ.get("AUTO_INDEX", "false").lower() == "true"
+# PostgreSQL truncates longer identifiers
+MAX_NAME_LENGTH = 63
+
+IndexAdvice = namedtuple("IndexAdvice", ["table", "columns", "name", "reason"])
+
+
+def index_name(table_name, columns):
+    """Build a valid, unique index name."""
+    name = re.sub(r"\W", "_", f"ix_{table_name}_{'_'.join(columns)}")
+    if len(name) > MAX_NAME_LENGTH:
+        suffix = get_digest(table_name, *columns).hex()[:8]
+        name = f"{name[:MAX_NAME_LENGTH - 9]}_{suffix}"
+    return name
+
+
+def cohort_feature_counts(conn, table_name):
+    """Count the stored cohort definitions that filter on each feature."""
+    if "cohort" not in conn.tables:
+        return Counter()
+    cohort = conn.tables["cohort"]
+    counts = Counter()
+    for (features,) in conn.execute(
+            cohort.select()
+            .with_only_columns([cohort.c.features])
+            .where(cohort.c.table == table_name)
+    ):
+        features = json.loads(features)
+        if isinstance(features, dict):
+            counts.update(features.keys())
+        else:
+            counts.update({feature["feature_name"] for feature in features})
+    return counts
+
+
+def advise(conn, table_names=TABLES, min_cohorts=None):
+    """List the indexes that the feature tables are missing.
+
+    These are indexes on (year, id), which also serves year filters, on
+    the id column (for the self-joins of multi-year cohorts), and on each
+    feature that at least `min_cohorts` stored cohorts filter on. An
+    existing index whose leading columns match counts as present.
+    """
+    if min_cohorts is None:
+        min_cohorts = INDEX_MIN_COHORTS
+    inspector = inspect(conn.connection)
+    advice = []
+    for table_name in table_names:
+        if table_name not in conn.tables:
+            continue
+        table_ = conn.tables[table_name]
+        existing = [
+            index["column_names"]
+            for index in inspector.get_indexes(table_name)
+        ]
+        primary_key = inspector.get_pk_constraint(table_name)["constrained_columns"]
+        if primary_key:
+            existing.append(primary_key)
+
+        id_column = table_name.capitalize() + "Id"
+        wanted = [
+            ([id_column], f"joins on {id_column}"),
+            (["year", id_column], f"year filters joined on {id_column}"),
+        ]
+        counts = cohort_feature_counts(conn, table_name)
+        wanted.extend(
+            ([feature], f"filtered on by {count} cohorts")
+            for feature, count in counts.most_common()
+            if count >= min_cohorts and feature in table_.c
+        )
+        for columns, reason in wanted:
+            if any(index[:len(columns)] == columns for index in existing):
+                continue
+            advice.append(IndexAdvice(
+                table_name,
+                columns,
+                index_name(table_name, columns),
+                reason,
+            ))
+    return advice
+
+
+def create_indexes(conn, advice):
+    """Create advised indexes, returning those created.
+
+    An index that cannot be created, e.g. because another process just
+    created it, is logged and skipped.
+    """
+    created = []
+    for index in advice:
+        table_ = conn.tables[index.table]
+        try:
+            Index(
+                index.name,
+                *(table_.c[column] for column in index.columns),
+            ).create(bind=conn.connection)
+        except DBAPIError as err:
+            logger.warning("Cannot create index %s: %s", index.name, err)
+            continue
+        logger.info("Created index %s on %s%s", index.name, index.table, index.columns)
+        created.append(index)
+    return created
+
+
+def auto_index():
+    """Create missing indexes, if AUTO_INDEX is set."""
+    if not AUTO_INDEX:
+        return
+    with DBConnection() as conn:
+        conn = ConnectionWithTables(conn, METADATA.get(conn))
+        create_indexes(conn, advise(conn))
+
+
+def main(args=None):
+    """Report, and optionally create, missing indexes."""
+    parser = argparse.ArgumentParser(
+        description="Report indexes missing from the feature tables.",
+    )
+    parser.add_argument("--create", action="store_true", help="create the missing indexes")
+    parser.add_argument("--tables", nargs="+", default=TABLES, help="tables to inspect")
+    parser.add_argument(
+        "--min-cohorts", type=int, default=INDEX_MIN_COHORTS,
+        help="index features used in at least this many cohort definitions",
+    )
+    args = parser.parse_args(args)
+
+    with DBConnection() as conn:
+        conn = ConnectionWithTables(conn, METADATA.get(conn))
+        advice = advise(conn, args.tables, args.min_cohorts)
+        for index in advice:
+            print(f"{index.table}({', '.join(index.columns)}): {index.reason}")
+        if not advice:
+            print("No missing indexes.")
+        elif args.create:
+            created = create_indexes(conn, advice)
+            print(f"Created {len(created)} of {len(advice)} indexes.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""Memory-mapped files of NumPy arrays.
+
+A file holds a magic number, the length of a JSON header, the header, and
+then the raw arrays, each aligned to 64 bytes. The header holds the
+caller's metadata and an index of the arrays: their offsets, dtypes and
+shapes. Loading maps the file read-only and views the arrays in place,
+so processes mapping the same file share its pages through the page
+cache, and nothing but the header is parsed.
+"""
+import json
+import mmap
+import os
+from pathlib import Path
+import struct
+
+import numpy as np
+
+MAGIC = b"ICEESMAP"
+ALIGNMENT = 64
+PREFIX = struct.Struct("<8sQ")
+
+
+def _aligned(offset):
+    """Round an offset up to the alignment."""
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def save(path, meta, arrays):
+    """Save metadata and named arrays.
+
+    The file is written next to its destination and then renamed over it,
+    so processes that mapped the old file keep reading the old data.
+    """
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+    index = {}
+    offset = 0
+    for name, array in arrays.items():
+        index[name] = {"offset": offset, "dtype": array.dtype.str, "shape": array.shape}
+        offset = _aligned(offset + array.nbytes)
+    header = json.dumps({"meta": meta, "arrays": index}).encode("utf-8")
+    start = _aligned(PREFIX.size + len(header))
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "wb") as stream:
+        stream.write(PREFIX.pack(MAGIC, len(header)))
+        stream.write(header)
+        for name, array in arrays.items():
+            stream.seek(start + index[name]["offset"])
+            stream.write(array.tobytes())
+        stream.truncate(start + offset)
+    os.replace(tmp_path, path)
+
+
+def load(path):
+    """Map a file, returning its metadata and read-only views of its arrays."""
+    with open(path, "rb") as stream:
+        buffer = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, header_size = PREFIX.unpack_from(buffer)
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a mapped array file")
+    header = json.loads(buffer[PREFIX.size:PREFIX.size + header_size])
+    start = _aligned(PREFIX.size + header_size)
+    arrays = {}
+    for name, entry in header["arrays"].items():
+        dtype = np.dtype(entry["dtype"])
+        shape = tuple(entry["shape"])
+        if 0 in shape:
+            arrays[name] = np.empty(shape, dtype=dtype)
+            continue
+        arrays[name] = np.frombuffer(
+            buffer,
+            dtype=dtype,
+            count=int(np.prod(shape)),
+            offset=start + entry["offset"],
+        ).reshape(shape)
+    return header["meta"], arrays
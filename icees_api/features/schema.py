@@ -0,0 +1,266 @@
+"""Tables maintained by ICEES API alongside the data tables."""
+from contextlib import nullcontext
+import logging
+from threading import Lock
+from weakref import WeakKeyDictionary
+
+from sqlalchemy import (
+    Column, Index, Integer, MetaData, String, Table, and_, inspect, select,
+    text,
+)
+from sqlalchemy.exc import DBAPIError, IntegrityError
+
+from ..db import DATA_VERSION
+
+logger = logging.getLogger(__name__)
+
+COHORT_ID_PREFIX = "COHORT:"
+
+_lock = Lock()
+_member_tables = WeakKeyDictionary()
+_materialized = WeakKeyDictionary()
+_counter_tables = WeakKeyDictionary()
+_migrated = WeakKeyDictionary()
+
+
+def cohort_member_table(conn) -> Table:
+    """Get the cohort membership table, creating it if necessary.
+
+    Each row is one (PatientId, year) row of the patient table that matches
+    the cohort definition, tagged with the data version it was computed
+    from. Column types are copied from the patient table.
+    """
+    engine = conn.connection.engine
+    with _lock:
+        members = _member_tables.get(engine)
+        if members is None:
+            patient = conn.tables["patient"]
+            members = Table(
+                "cohort_member",
+                MetaData(),
+                Column("cohort_id", String(255), nullable=False),
+                Column("data_version", String(255), nullable=False),
+                Column("PatientId", patient.c["PatientId"].type, nullable=False),
+                Column("year", patient.c["year"].type),
+                Index(
+                    "ix_cohort_member_cohort_id",
+                    "cohort_id", "data_version", "PatientId", "year",
+                ),
+            )
+            members.create(bind=conn.connection, checkfirst=True)
+            _member_tables[engine] = members
+            _materialized[engine] = set()
+    return members
+
+
+def is_materialized(conn, cohort_id) -> bool:
+    """Determine whether a cohort is materialized for the current data."""
+    members = cohort_member_table(conn)
+    materialized = _materialized[conn.connection.engine]
+    if cohort_id in materialized:
+        return True
+    s = select([members.c.cohort_id])\
+        .where(members.c.cohort_id == cohort_id)\
+        .where(members.c.data_version == DATA_VERSION)\
+        .limit(1)
+    if conn.execute(s).first() is None:
+        return False
+    materialized.add(cohort_id)
+    return True
+
+
+def store_cohort_members(conn, cohort_id, rows):
+    """Replace the members of a cohort with the rows of a selectable.
+
+    `rows` selects the cohort_id, data_version, PatientId and year of
+    each member. Members left over from other data versions are removed
+    at the same time. The delete and insert happen in one transaction, so
+    that concurrent materializations cannot delete each other's members
+    halfway.
+    """
+    members = cohort_member_table(conn)
+    connection = conn.connection
+    with nullcontext() if connection.in_transaction() else connection.begin():
+        connection.execute(members.delete().where(
+            (members.c.cohort_id == cohort_id)
+            | (members.c.data_version != DATA_VERSION)
+        ))
+        connection.execute(members.insert().from_select(
+            ["cohort_id", "data_version", "PatientId", "year"],
+            rows,
+        ))
+    _materialized[conn.connection.engine].add(cohort_id)
+
+
+def select_cohort_members(conn, cohort_id):
+    """Select the distinct (PatientId, year) members of a cohort."""
+    members = cohort_member_table(conn)
+    return select([members.c.PatientId, members.c.year])\
+        .where(and_(
+            members.c.cohort_id == cohort_id,
+            members.c.data_version == DATA_VERSION,
+        ))\
+        .distinct()
+
+
+def cohort_counter_table(conn) -> Table:
+    """Get the cohort id counter table, creating it if necessary.
+
+    Its one row holds the number of the last allocated COHORT:<n> id, and
+    is seeded from the ids already in the cohort table.
+    """
+    engine = conn.connection.engine
+    with _lock:
+        counter = _counter_tables.get(engine)
+        if counter is None:
+            counter = Table(
+                "cohort_counter",
+                MetaData(),
+                Column("name", String(255), primary_key=True),
+                Column("value", Integer, nullable=False),
+            )
+            counter.create(bind=conn.connection, checkfirst=True)
+            _seed_cohort_counter(conn, counter)
+            _counter_tables[engine] = counter
+    return counter
+
+
+def _seed_cohort_counter(conn, counter):
+    """Start the counter after the largest COHORT:<n> id in use."""
+    s = select([counter.c.value]).where(counter.c.name == "cohort")
+    if conn.execute(s).first() is not None:
+        return
+    cohort = conn.tables["cohort"]
+    numbers = [
+        int(suffix)
+        for (cohort_id,) in conn.execute(
+            select([cohort.c.cohort_id])
+            .where(cohort.c.cohort_id.startswith(COHORT_ID_PREFIX))
+        )
+        if (suffix := cohort_id[len(COHORT_ID_PREFIX):]).isdigit()
+    ]
+    try:
+        conn.execute(counter.insert().values(
+            name="cohort",
+            value=max(numbers, default=0),
+        ))
+    except IntegrityError:
+        # another process seeded it first
+        pass
+
+
+def allocate_cohort_id(conn) -> str:
+    """Allocate the next COHORT:<n> id.
+
+    The increment and read happen in one transaction, so concurrent
+    allocations get different ids.
+    """
+    counter = cohort_counter_table(conn)
+    connection = conn.connection
+    with nullcontext() if connection.in_transaction() else connection.begin():
+        connection.execute(
+            counter.update()
+            .where(counter.c.name == "cohort")
+            .values(value=counter.c.value + 1)
+        )
+        value = connection.execute(
+            select([counter.c.value]).where(counter.c.name == "cohort")
+        ).scalar()
+    return f"{COHORT_ID_PREFIX}{value}"
+
+
+def _cohort_primary_key(conn):
+    """Make cohort_id the key of the cohort table.
+
+    SQLite cannot add a primary key to an existing table, but its primary
+    keys on text columns are unique indexes anyway, so it gets one of
+    those.
+    """
+    inspector = inspect(conn.connection)
+    if inspector.get_pk_constraint("cohort")["constrained_columns"]:
+        return
+    if any(
+            index["column_names"] == ["cohort_id"] and index["unique"]
+            for index in inspector.get_indexes("cohort")
+    ):
+        return
+    if conn.connection.dialect.name == "sqlite":
+        Index(
+            "ux_cohort_cohort_id",
+            conn.tables["cohort"].c.cohort_id,
+            unique=True,
+        ).create(bind=conn.connection)
+    else:
+        conn.execute(text("ALTER TABLE cohort ADD PRIMARY KEY (cohort_id)"))
+
+
+def _cohort_features_digest(conn):
+    """Add an indexed digest of each cohort's features.
+
+    Looking cohorts up by (table, year, features_digest) replaces comparing
+    the whole features text of every cohort.
+    """
+    # sql imports this module
+    from .sql import features_digest
+
+    if "features_digest" not in conn.tables["cohort"].c:
+        conn.execute(text("ALTER TABLE cohort ADD COLUMN features_digest VARCHAR(32)"))
+    cohort = Table("cohort", MetaData(), autoload_with=conn.connection)
+    # the digest depends only on the features, which also tells apart
+    # rows that share a cohort id
+    for (features,) in conn.execute(
+            select([cohort.c.features])
+            .where(cohort.c.features_digest.is_(None))
+            .distinct()
+    ).fetchall():
+        conn.execute(
+            cohort.update()
+            .where(cohort.c.features == features)
+            .where(cohort.c.features_digest.is_(None))
+            .values(features_digest=features_digest(features))
+        )
+    Index(
+        "ix_cohort_features_digest",
+        cohort.c.table, cohort.c.year, cohort.c.features_digest,
+    ).create(bind=conn.connection)
+
+
+# in order; names are recorded once applied, so never rename one
+MIGRATIONS = [
+    ("cohort_primary_key", _cohort_primary_key),
+    ("cohort_features_digest", _cohort_features_digest),
+]
+
+
+def migrate(conn):
+    """Apply the migrations that this database has not had yet.
+
+    Migrations run once per engine, each in its own transaction, and the
+    connection's tables are reflected again afterwards. A migration that
+    fails (e.g. keying cohorts that have duplicate ids) is logged and
+    retried by the next process; the others are still applied.
+    """
+    engine = conn.connection.engine
+    with _lock:
+        if engine in _migrated or "cohort" not in conn.tables:
+            # up to date, or the data are not loaded yet
+            return
+        migrations = Table(
+            "schema_migration",
+            MetaData(),
+            Column("name", String(255), primary_key=True),
+        )
+        migrations.create(bind=conn.connection, checkfirst=True)
+        applied = {name for (name,) in conn.execute(select([migrations.c.name]))}
+        for name, migration in MIGRATIONS:
+            if name in applied:
+                continue
+            try:
+                with conn.connection.begin():
+                    migration(conn)
+                    conn.execute(migrations.insert().values(name=name))
+            except DBAPIError as err:
+                logger.warning("Migration %s failed: %s", name, err)
+            finally:
+                conn.refresh_tables()
+        _migrated[engine] = True
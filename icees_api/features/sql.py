@@ -1,6 +1,6 @@
 """SQL access functions."""
-from collections import defaultdict, namedtuple
-from functools import wraps
+from collections import Counter, defaultdict
+from contextvars import copy_context
 from hashlib import md5
 from itertools import product, chain
 import json
@@ -10,27 +10,28 @@ import operator
 import os
 import time
 from decimal import Decimal
+from threading import Lock
 from typing import Any, Callable, Dict, List, Union
+from weakref import WeakKeyDictionary
 from fastapi import HTTPException
 import numpy as np
-import redis
-from scipy.stats import chi2_contingency, fisher_exact, contingency
-from sqlalchemy import and_, between, case, column, table, Float
-from sqlalchemy.sql.expression import cast
+import pandas as pd
+from sqlalchemy import and_, between, case, column, literal, table, Float, Table
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql.expression import cast, TableClause
 
 from sqlalchemy.sql import select, func, distinct
-from statsmodels.stats.multitest import multipletests
 from tx.functional.maybe import Nothing, Just
 
+from ..db import DATA_VERSION
 from .mappings import get_value_sets
+from . import columnar, cube, fanout, schema
+from .cache import cached
+from .stats import ConfidenceInterval, correct_p_values, table_statistics
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-eps = np.finfo(float).eps
-ConfidenceInterval = namedtuple('ConfidenceInterval', ['low', 'high'])
-
-
 def get_digest(*args):
     """Get digest."""
     c = md5()
@@ -39,6 +40,11 @@ def get_digest(*args):
     return c.digest()
 
 
+def features_digest(features):
+    """Get the fixed-width digest of a cohort's features JSON."""
+    return get_digest(features).hex()
+
+
 def op_dict(k, v, table_=None):
     if table_ is not None:
         try:
@@ -106,45 +112,130 @@ def case_select2(table1, table2, k, v, k2, v2):
 def select_cohort(conn, table_name, year, cohort_features, cohort_id=None):
     """Select cohort."""
     cohort_features_norm = normalize_features(year, cohort_features)
-    gen_table, _, pk = generate_tables_from_features(table_name, cohort_features_norm, year, [])
-    s = select([func.count(column(pk).distinct())]).select_from(gen_table)
-    n = conn.execute(s).scalar()
+    parent = find_parent_cohort(conn, table_name, cohort_features_norm)
+    if parent is None:
+        n = count_cohort(conn, table_name, year, cohort_features_norm)
+    else:
+        # only the features that the parent lacks need evaluating
+        table_ = refine_cohort(conn, table_name, *parent)
+        n = conn.execute(select([func.count(table_.c["PatientId"].distinct())])).scalar()
     if n <= 10:
         return None, -1
     else:
         size = n
-        next_val = 0
-        while cohort_id is None:
-            next_val += 1
-            cohort_id = "COHORT:" + str(next_val)
+        features = json.dumps(cohort_features, sort_keys=True)
+        if cohort_id is None:
+            for _ in range(COHORT_ID_ATTEMPTS):
+                cohort_id = schema.allocate_cohort_id(conn)
+                if cohort_id_in_use(conn, cohort_id):
+                    # the id was taken explicitly; without the cohort key
+                    # (see schema.migrate) inserting would not fail
+                    continue
+                try:
+                    insert_cohort(conn, cohort_id, size, features, table_name, year)
+                    break
+                except IntegrityError:
+                    # the id was taken explicitly; try the next one
+                    continue
+            else:
+                raise RuntimeError("Cannot allocate a cohort id.")
+        else:
             if cohort_id_in_use(conn, cohort_id):
-                cohort_id = None
+                raise HTTPException(status_code=400, detail="Cohort id is in use.")
+            try:
+                insert_cohort(conn, cohort_id, size, features, table_name, year)
+            except IntegrityError:
+                raise HTTPException(status_code=400, detail="Cohort id is in use.")
 
-        if cohort_id_in_use(conn, cohort_id):
-            raise HTTPException(status_code=400, detail="Cohort id is in use.")
-
-        query = "INSERT INTO cohort (cohort_id, size, features, \"table\", year)"
-        if os.environ.get("ICEES_DB", "sqlite") == "sqlite":
-            query += " VALUES (?, ?, ?, ?, ?)"
-        else:
-            query += " VALUES (%s, %s, %s, %s, %s)"
-        conn.execute(query, (
-            cohort_id,
-            size,
-            json.dumps(cohort_features, sort_keys=True),
-            table_name,
-            year,
-        ))
+        get_cohort_dictionary.invalidate(conn, table_name, None)
+        if year is not None:
+            get_cohort_dictionary.invalidate(conn, table_name, year)
+        if MATERIALIZE_COHORTS and can_materialize(conn, table_name, cohort_features_norm):
+            materialize_cohort(conn, table_name, cohort_id, cohort_features, parent=parent)
         return cohort_id, size
 
 
+COHORT_ID_ATTEMPTS = 100
+
+
+_unique_patient_years = WeakKeyDictionary()
+_unique_patient_years_lock = Lock()
+
+
+def unique_patient_years(conn, table_name) -> bool:
+    """Determine whether a table has at most one row per patient and year.
+
+    The table is probed once per engine and data version.
+    """
+    engine = conn.connection.engine
+    key = (table_name, DATA_VERSION)
+    with _unique_patient_years_lock:
+        known = _unique_patient_years.setdefault(engine, {})
+        if key in known:
+            return known[key]
+    table_ = conn.tables.get(table_name)
+    if table_ is None or "PatientId" not in table_.c or "year" not in table_.c:
+        unique = False
+    else:
+        unique = conn.execute(
+            select([table_.c["PatientId"]])
+            .group_by(table_.c["PatientId"], table_.c["year"])
+            .having(func.count() > 1)
+            .limit(1)
+        ).first() is None
+    with _unique_patient_years_lock:
+        known[key] = unique
+    return unique
+
+
+def count_cohort(conn, table_name, year, cohort_features_norm):
+    """Count the distinct patients matching normalized cohort features."""
+    if columnar.ENABLED:
+        try:
+            return columnar.count_cohort(conn, table_name, year, cohort_features_norm)
+        except columnar.Unsupported:
+            pass
+    gen_table, _, pk = generate_tables_from_features(
+        table_name, cohort_features_norm, year, [],
+        one_row_per_year=unique_patient_years(conn, table_name),
+    )
+    s = select([func.count(column(pk).distinct())]).select_from(gen_table)
+    return conn.execute(s).scalar()
+
+
+def has_features_digest(conn):
+    """Determine whether the cohort table has its features digest column.
+
+    The column is added by a migration, which may not have been applied.
+    """
+    return "features_digest" in conn.tables["cohort"].c
+
+
+def insert_cohort(conn, cohort_id, size, features, table_name, year):
+    """Insert a cohort."""
+    values = [cohort_id, size, features, table_name, year]
+    query = "INSERT INTO cohort (cohort_id, size, features, \"table\", year"
+    if has_features_digest(conn):
+        values.append(features_digest(features))
+        query += ", features_digest"
+    if os.environ.get("ICEES_DB", "sqlite") == "sqlite":
+        placeholder = "?"
+    else:
+        placeholder = "%s"
+    query += ") VALUES (" + ", ".join(placeholder for _ in values) + ")"
+    conn.execute(query, tuple(values))
+
+
 def get_ids_by_feature(conn, table_name, year, cohort_features):
     """Get ids by feature."""
+    features = json.dumps(cohort_features, sort_keys=True)
     s = select([column("cohort_id"), column("size")])\
         .select_from(table("cohort"))\
         .where(column("table") == table_name)\
         .where(column("year") == year)\
-        .where(column("features") == json.dumps(cohort_features, sort_keys=True))
+        .where(column("features") == features)
+    if has_features_digest(conn):
+        s = s.where(column("features_digest") == features_digest(features))
     rs = list(conn.execute(s))
     if len(rs) == 0:
         cohort_id, size = select_cohort(conn, table_name, year, cohort_features)
@@ -162,6 +253,13 @@ def get_features(conn, table_name: str) -> List[str]:
     ]
 
 
+def cohort_key(conn, table_name, *args):
+    """Digest the table and cohort arguments of a cohort lookup."""
+    return get_digest(table_name, *map(str, args))
+
+
+# cohorts are never modified, so only the dictionary needs invalidation
+@cached(key=cohort_key, load=tuple, local=True)
 def get_features_by_id(conn, table_name, cohort_id):
     """Get features by id."""
     s = select([column("features"), column("year")])\
@@ -174,6 +272,7 @@ def get_features_by_id(conn, table_name, cohort_id):
     return json.loads(rs[0][0]), rs[0][1]
 
 
+@cached(key=cohort_key, local=True)
 def get_cohort_by_id(conn, table_name, year, cohort_id):
     """Get cohort by id."""
     s = select([column("features"), column("size")])\
@@ -190,24 +289,53 @@ def get_cohort_by_id(conn, table_name, year, cohort_id):
     }
 
 
-def get_cohort_features(conn, table_name, feats, year, cohort_features, cohort_year):
+def get_cohort_features_key(
+        conn,
+        table_name,
+        feats,
+        year,
+        cohort_features,
+        cohort_year,
+        cohort_id=None,
+):
+    """Digest the arguments that determine get_cohort_features's result."""
+    return get_digest(
+        table_name,
+        str(year),
+        feature_key(normalize_features(cohort_year, cohort_features)),
+        str(cohort_year),
+        feature_key(list(feats)),
+    )
+
+
+@cached(key=get_cohort_features_key, local=True)
+def get_cohort_features(
+        conn,
+        table_name,
+        feats,
+        year,
+        cohort_features,
+        cohort_year,
+        cohort_id=None,
+):
     """Get cohort features."""
+    counts = count_values(
+        conn,
+        table_name,
+        year,
+        cohort_features,
+        cohort_year,
+        list(feats),
+        cohort_id=cohort_id,
+    )
     rs = []
     for k in feats:
         levels = get_feature_levels(k, year=year, cohort_feat_dict=cohort_features)
-        ret = select_feature_count_all_values(
-            conn,
-            table_name,
-            year,
-            cohort_features,
-            cohort_year,
-            k,
-            levels
-        )
-        rs.append(ret)
+        rs.append(feature_count(k, year, counts[k], levels))
     return rs
 
 
+@cached(key=cohort_key, local=True)
 def get_cohort_dictionary(conn, table_name, year):
     """Get cohort dictionary."""
     s = select([column("cohort_id"), column("features"), column("size")])\
@@ -266,12 +394,8 @@ def div(a,b):
         return float("NaN")
 
 
-def add_eps(a):
-    """Add epsilon."""
-    return a + eps
-
-
 MAX_ENTRIES_PER_ROW = int(os.environ.get("MAX_ENTRIES_PER_ROW", "1664"))
+FETCH_SIZE = int(os.environ.get("FETCH_SIZE", "10000"))
 
 def timeit(method):
     def timed(*args, **kw):
@@ -283,17 +407,47 @@ def timeit(method):
     return timed
 
 
+def _table_with_columns(table_, column_names):
+    """Get a selectable exposing the named columns.
+
+    Table names become lightweight tables with the columns appended;
+    reflected tables and other selectables already expose all of their
+    columns and are never modified.
+    """
+    if isinstance(table_, str):
+        table_ = table(table_)
+    if isinstance(table_, TableClause) and not isinstance(table_, Table):
+        for column_name in column_names:
+            if column_name not in table_.c:
+                table_.append_column(column(column_name))
+    return table_
+
+
 def generate_tables_from_features(
         table_name,
         cohort_features,
         cohort_year,
         columns,
-        primary_key='PatientId'
+        primary_key='PatientId',
+        one_row_per_year=False,
 ):
-    """Generate tables from features."""
-    table_ = table(table_name, column(primary_key))
-
-    table_cohorts = []
+    """Generate tables from features.
+
+    `table_name` is either the name of a table or a selectable, such as one
+    returned by cohort_table, to select rows from.
+
+    The rows of each column year (the matrices) are joined, on the primary
+    key, to the rows matching each group of cohort features of a year.
+    With `one_row_per_year`, i.e. if each key has at most one row per year
+    (as in the patient table), a key matches at most one row of any year,
+    so:
+    * a feature group of a matrix's year filters the matrix's own rows, and
+      the common single-year case is one scan, and
+    * other feature groups of a year are semijoins (IN subqueries).
+    Feature groups of no year may match several rows per key and still
+    multiply the rows they are joined to, so they remain joins.
+    """
+    table_ = _table_with_columns(table_name, [primary_key])
 
     cohort_feature_groups = defaultdict(list)
     for cohort_feature in cohort_features:
@@ -301,80 +455,90 @@ def generate_tables_from_features(
         v = cohort_feature["feature_qualifier"]
         feature_year = cohort_feature["year"]
         cohort_feature_groups[feature_year].append((k, v))
-
-    for feature_year, features in cohort_feature_groups.items():
-
-        table_cohort_feature_group = (
-            select([table_.c[primary_key]])\
-            .select_from(table_)
-        )  # SELECT "PatientId" FROM patient
-        if feature_year is not None:
-            table_cohort_feature_group = (
-                table_cohort_feature_group\
-                .where(column("year") == feature_year)
-            )  # SELECT "PatientId" FROM patient WHERE year = 2010
-
-        for k, v in features:
-            table_.append_column(column(k))
-            table_cohort_feature_group = filter_select(
-                table_cohort_feature_group,
-                k,
-                v,
-                table_,
-            )  # SELECT "PatientId" FROM patient WHERE patient."AgeStudyStart" = '0-2'
-
-        table_cohort_feature_group = table_cohort_feature_group.alias()
-        table_cohorts.append(table_cohort_feature_group)
-
     if len(cohort_feature_groups) == 0:
-        table_cohort_feature_group = (
-            select([table_.c[primary_key]])\
-            .select_from(table_)
-        )  # SELECT "PatientId" FROM patient
-        if cohort_year is not None:
-            table_cohort_feature_group = (
-                table_cohort_feature_group\
-                .where(column("year") == cohort_year)
-            )  # SELECT "PatientId" FROM patient WHERE year = 2010
-
-        table_cohort_feature_group = table_cohort_feature_group.alias()
-        table_cohorts.append(table_cohort_feature_group)
-
-    table_matrices = {}
+        cohort_feature_groups[cohort_year] = []
 
     column_groups = defaultdict(list)
-
     for column_name, year in columns:
         column_groups[year].append(column_name)
 
-    table_ = table(table_name)
-    for year, column_names in column_groups.items():
-        for column_name in chain([primary_key], column_names):
-            table_.append_column(column(column_name))
-
-    for year, column_names in column_groups.items():
-
-        table_matrix = select([
+    table_ = _table_with_columns(table_name, [primary_key, *(
+        column_name
+        for column_names in column_groups.values()
+        for column_name in column_names
+    ), *(
+        k
+        for features in cohort_feature_groups.values()
+        for k, _ in features
+    )])
+
+    def scan(year, column_names, features):
+        """Select the key and columns of the rows of a year matching features."""
+        s = select([
             table_.c[x]
             for x in chain([primary_key], column_names)
-        ]).select_from(table_)
-
+        ]).select_from(table_)  # SELECT "PatientId" FROM patient
         if year is not None:
-            table_matrix = table_matrix.where(column("year") == year)
+            s = s.where(column("year") == year)  # WHERE year = 2010
+        for k, v in features:
+            s = filter_select(s, k, v, table_)  # AND patient."AgeStudyStart" = '0-2'
+        return s
 
-        table_matrix = table_matrix.alias()
-        table_matrices[year] = table_matrix
+    table_matrices = {}
+    for year, column_names in column_groups.items():
+        if one_row_per_year and year is not None and year in cohort_feature_groups:
+            s = scan(year, column_names, cohort_feature_groups.pop(year))
+            # as the join to the group's rows would, drop the rows of no key
+            s = s.where(table_.c[primary_key].isnot(None))
+        else:
+            s = scan(year, column_names, [])
+        table_matrices[year] = s.alias()
+
+    table_cohorts = [
+        (feature_year, scan(feature_year, [], features))
+        for feature_year, features in cohort_feature_groups.items()
+    ]
+    if table_matrices:
+        matrices = list(table_matrices.values())
+    else:
+        # the rows of the first feature group take the place of a matrix
+        matrices = [table_cohorts.pop(0)[1].alias()]
+    semijoins = [
+        table_cohort for feature_year, table_cohort in table_cohorts
+        if one_row_per_year and feature_year is not None
+    ]
+    table_cohorts = [
+        table_cohort for feature_year, table_cohort in table_cohorts
+        if not (one_row_per_year and feature_year is not None)
+    ]
+    table_cohort = matrices[0]
 
-    tables_all = [*table_matrices.values(), *table_cohorts]
-    table_cohort = tables_all[0]
+    if len(matrices) == 1 and not table_cohorts and not semijoins:
+        return table_cohort, table_matrices, primary_key
+
+    # the key and columns of the result are selected explicitly, so that
+    # the keys of the joined tables do not make them ambiguous
     table_filtered = table_cohort
-    for _table in tables_all[1:]:
+    for _table in chain(
+            matrices[1:],
+            (table_cohort_.alias() for table_cohort_ in table_cohorts),
+    ):
         table_filtered = table_filtered.join(
             _table,
             onclause=table_cohort.c[primary_key] == _table.c[primary_key],
         )
-
-    return table_filtered, table_matrices, primary_key
+    exposed = [table_cohort.c[primary_key]] + [
+        c
+        for matrix in matrices
+        for c in matrix.c
+        if c.name != primary_key
+    ]
+    table_filtered = select(exposed).select_from(table_filtered)
+    for semijoin in semijoins:
+        table_filtered = table_filtered.where(
+            table_cohort.c[primary_key].in_(semijoin)
+        )
+    return table_filtered.alias(), table_matrices, primary_key
 
 
 def selection(conn, table, selections):
@@ -452,43 +616,103 @@ def simplify_value(val_str, opr):
     return val_str
 
 
-def get_count(results, **constraints):
-    """Get sum of result counts that meet constraints."""
-    count = 0
-    for result in results:
-        if all(
-            OP_MAP[constraint["operator"]](
-                simplify_value(result.get(feature, None), constraint["operator"]),
-                simplify_value(constraint.get("value", constraint.get("values")), constraint["operator"]),
-            )
-            for feature, constraint in constraints.items()
-        ):
-            count += result["count"]
-    return count
+def satisfies(value, qualifier):
+    """Determine whether a value satisfies a feature qualifier."""
+    opr = qualifier["operator"]
+    return OP_MAP[opr](
+        simplify_value(value, opr),
+        simplify_value(qualifier.get("value", qualifier.get("values")), opr),
+    )
 
 
-REDIS_HOST = os.environ.get("REDIS_HOST", "localhost")
-r = redis.Redis(host=REDIS_HOST)
+def qualifier_masks(values, qualifiers):
+    """Map each value to the qualifiers it satisfies.
 
+    Each distinct value is tested against the qualifiers only once. The
+    result is a boolean array of shape (len(values), len(qualifiers)).
+    """
+    lookup = {}
+    masks = np.zeros((len(values), len(qualifiers)), dtype=bool)
+    for i, value in enumerate(values):
+        if value not in lookup:
+            lookup[value] = [satisfies(value, q) for q in qualifiers]
+        masks[i] = lookup[value]
+    return masks
+
+
+def contingency_table(results, qualifiers_a, qualifiers_b):
+    """Build a contingency table from grouped counts in one pass.
+
+    `results` are [value_a, value_b, count] rows as returned by
+    count_unique. Returns the matrix (one row per qualifier in
+    `qualifiers_b`, one column per qualifier in `qualifiers_a`), the row
+    totals, the column totals and the grand total.
+    """
+    counts = np.array([row[-1] for row in results], dtype=np.int64)
+    masks_a = qualifier_masks([row[0] for row in results], qualifiers_a)
+    masks_b = qualifier_masks([row[1] for row in results], qualifiers_b)
+    matrix = masks_b.T.astype(np.int64) @ (masks_a * counts[:, None])
+    total_rows = counts @ masks_b
+    total_cols = counts @ masks_a
+    return (
+        matrix.tolist(),
+        total_rows.tolist(),
+        total_cols.tolist(),
+        int(counts.sum()),
+    )
 
-def cached(key=lambda *args: hash(tuple(args))):
-    """Generate a decorator to cache results."""
-    def decorator(func):
-        """Decorate a function to cache results."""
-        @wraps(func)
-        def wrapper(*args):
-            key_ = key(*args)
-            cached_result = r.get(key_)
-            if cached_result is not None:
-                return json.loads(cached_result)
-            result = func(*args)
-            r.set(key_, json.dumps(result))
-            return result
-        return wrapper
-    return decorator
 
+def get_frequencies(results, columns, constraints):
+    """Get, for each set of constraints, the sum of result counts meeting it.
 
-def count_unique(conn, table_name, year, *columns):
+    `results` are rows of values for `columns` followed by a count, as
+    returned by count_unique. Each entry of `constraints` maps column names
+    to qualifiers.
+    """
+    counts = np.array([row[-1] for row in results], dtype=np.int64)
+    masks = {}
+    frequencies = []
+    for constraint in constraints:
+        mask = np.ones(len(results), dtype=bool)
+        for feature, qualifier in constraint.items():
+            key = (feature, feature_key(qualifier))
+            if key not in masks:
+                index = columns.index(feature)
+                masks[key] = qualifier_masks(
+                    [row[index] for row in results],
+                    [qualifier],
+                )[:, 0]
+            mask &= masks[key]
+        frequencies.append(int(counts @ mask))
+    return frequencies
+
+
+def count_unique_key(
+        conn,
+        table_name,
+        year,
+        *columns,
+        cohort_features=None,
+        cohort_id=None,
+):
+    """Digest the arguments that determine count_unique's result."""
+    return get_digest(
+        table_name,
+        str(year),
+        feature_key(columns),
+        feature_key(normalize_features(None, cohort_features or [])),
+    )
+
+
+@cached(key=count_unique_key)
+def count_unique(
+        conn,
+        table_name,
+        year,
+        *columns,
+        cohort_features=None,
+        cohort_id=None,
+):
     """Count each unique combination of column values.
 
     For example, for columns = ["a", "b"] and data
@@ -506,72 +730,276 @@ def count_unique(conn, table_name, year, *columns):
         [1, 2, 2],
         [2, 2, 1]
     ]
+
+    Only rows matching `cohort_features` are counted.
     """
-    if not year:
-        return [list(row) for row in conn.execute(
-            "SELECT {cols}, count(*) FROM {table_name} WHERE {cols_not_null} GROUP BY {cols}".format(
-                cols=", ".join(f"\"{col}\"" for col in columns),
-                cols_not_null=" AND ".join(f"\"{col}\" is not null" for col in columns),
-                table_name=table_name,
+    cohort_features_norm = normalize_features(None, cohort_features or [])
+    try:
+        return cube.count_unique(table_name, year, columns, cohort_features_norm)
+    except columnar.Unsupported:
+        pass
+    if columnar.ENABLED:
+        try:
+            return columnar.count_unique(
+                conn, table_name, year, columns, cohort_features_norm,
             )
-        ).fetchall()]
-    else:
-        return [list(row) for row in conn.execute(
-            "SELECT {cols}, count(*) FROM {table_name} WHERE \"year\" = {year} AND {cols_not_null} GROUP BY {cols}".format(
-                cols=", ".join(f"\"{col}\"" for col in columns),
-                table_name=table_name,
-                year=year,
-                cols_not_null=" AND ".join(f"\"{col}\" is not null" for col in columns),
+        except columnar.Unsupported:
+            pass
+    table_ = cohort_table(conn, table_name, cohort_features, cohort_id)
+    cols = [table_.c[col] for col in columns]
+    s = select([*cols, func.count()])\
+        .select_from(table_)\
+        .where(and_(*(col.isnot(None) for col in cols)))\
+        .group_by(*cols)
+    if year:
+        s = s.where(table_.c["year"] == year)
+    return [list(row) for row in conn.execute(s).fetchall()]
+
+
+def count_unique_pairs(
+        conn,
+        table_name,
+        year,
+        column_a,
+        columns_b,
+        cohort_features=None,
+        cohort_id=None,
+):
+    """Count each unique pair of values of one column with each of others.
+
+    The result for each column in `columns_b` is the same as that of
+    count_unique(conn, table_name, year, column_a, column_b), but the
+    cohort rows are read only once for all of them.
+    """
+    if not columns_b:
+        return {}
+    cohort_features_norm = normalize_features(None, cohort_features or [])
+    try:
+        return cube.count_unique_pairs(
+            table_name, year, column_a, columns_b, cohort_features_norm,
+        )
+    except columnar.Unsupported:
+        pass
+    if columnar.ENABLED:
+        try:
+            return columnar.count_unique_pairs(
+                conn, table_name, year, column_a, columns_b, cohort_features_norm,
             )
-        ).fetchall()]
+        except columnar.Unsupported:
+            pass
+    table_ = cohort_table(conn, table_name, cohort_features, cohort_id)
+    counts = {column_b: Counter() for column_b in columns_b}
+    others = [
+        column_b for column_b in counts
+        if column_b != column_a
+    ]
+    for i in range(0, max(len(others), 1), MAX_ENTRIES_PER_ROW - 1):
+        names = [column_a, *others[i:i + MAX_ENTRIES_PER_ROW - 1]]
+        s = select([table_.c[name] for name in names])\
+            .where(table_.c[column_a].isnot(None))
+        if year:
+            s = s.where(table_.c["year"] == year)
+        result = conn.execute(s)
+        while rows := result.fetchmany(FETCH_SIZE):
+            values = [np.array(col, dtype=object) for col in zip(*rows)]
+            if i == 0 and column_a in counts:
+                # every chunk selects column_a; count its pairs once
+                count_pairs(values[0], values[0], counts[column_a])
+            for name, values_b in zip(names[1:], values[1:]):
+                count_pairs(values[0], values_b, counts[name])
+    return {
+        column_b: [[value_a, value_b, count] for (value_a, value_b), count in counter.items()]
+        for column_b, counter in counts.items()
+    }
+
+
+def count_pairs(values_a, values_b, counts):
+    """Add the number of occurrences of each non-null value pair to counts."""
+    codes_a, uniques_a = pd.factorize(values_a)
+    codes_b, uniques_b = pd.factorize(values_b)
+    valid = (codes_a >= 0) & (codes_b >= 0)
+    pair_counts = np.bincount(
+        codes_a[valid] * len(uniques_b) + codes_b[valid],
+        minlength=len(uniques_a) * len(uniques_b),
+    )
+    for code in np.flatnonzero(pair_counts):
+        a, b = divmod(code, len(uniques_b))
+        counts[uniques_a[a], uniques_b[b]] += int(pair_counts[code])
+
 
+def cohort_table(conn, table_name, cohort_features, cohort_id=None):
+    """Get a selectable of the table rows matching the cohort features.
 
-def create_cohort_view(conn, table_name, cohort_features):
-    if not isinstance(cohort_features, list):
+    The cohort filter is inlined as a subquery so that concurrent requests
+    never share database objects. Per-feature years are ignored; every
+    feature is applied to each row. If the cohort is materialized, rows
+    are selected by joining its members instead.
+    """
+    table_ = conn.tables[table_name]
+    if not cohort_features:
+        return table_
+    members = cohort_members(conn, table_name, cohort_id, cohort_features)
+    if members is not None:
+        members = members.alias("members")
+        return select([table_]).select_from(table_.join(members, and_(
+            table_.c["PatientId"] == members.c["PatientId"],
+            table_.c["year"] == members.c["year"],
+        ))).alias("cohort")
+    if isinstance(cohort_features, dict):
         cohort_features = [
-            {
-                "feature_name": key,
-                "feature_qualifier": {
-                    "operator": value["operator"],
-                    # value only has two possible keys, value key for one value, and values key for a list of values
-                    # format value["values"] list into ("value1", "value2", ...,) for SQL IN operator query
-                    "value": value.get("value") if value.get("value") is not None
-                    else '("{}")'.format('\", \"'.join(value["values"]))
-                }
-            }
-            for key, value in cohort_features.items()
+            {"feature_name": k, "feature_qualifier": v}
+            for k, v in cohort_features.items()
         ]
-
-    if cohort_features:
-        # only add quotation marks to value if operator is =
-        condition_str = " AND ".join(
-            ("\"{}\" {} \"{}\"" if feature["feature_qualifier"]["operator"] == '=' else "\"{}\" {} {}").format(
-                feature["feature_name"],
-                feature["feature_qualifier"]["operator"],
-                feature["feature_qualifier"]["value"]
-            ) for feature in cohort_features)
-
-        view_query = (
-            "CREATE VIEW tmp AS "
-            "SELECT * FROM {} "
-            "WHERE {}"
-        ).format(
-            table_name,
-            condition_str
+    return select([table_]).where(and_(*(
+        op_dict(
+            feature["feature_name"],
+            feature["feature_qualifier"],
+            table_=table_,
         )
-        conn.execute("DROP VIEW if exists tmp")
-        conn.execute(view_query)
-        # return the view table name 'tmp' for subsequent operations
-        return 'tmp'
+        for feature in cohort_features
+    ))).alias("cohort")
+
+
+MATERIALIZE_COHORTS = os.environ.get("MATERIALIZE_COHORTS", "false").lower() == "true"
+
+
+def can_materialize(conn, table_name, cohort_features_norm):
+    """Determine whether a cohort's membership can be materialized.
+
+    Only patient cohorts whose features are not tied to a year can be
+    represented by their matching (PatientId, year) rows, and only if no
+    patient has several rows in a year, one of which might not match.
+    """
+    return (
+        table_name == "patient"
+        and len(cohort_features_norm) > 0
+        and all(feature["year"] is None for feature in cohort_features_norm)
+        and unique_patient_years(conn, table_name)
+    )
+
+
+def materialize_cohort(conn, table_name, cohort_id, cohort_features, parent=None):
+    """Store the (PatientId, year) rows matching the cohort features.
+
+    `parent`, as returned by find_parent_cohort, refines the members of a
+    parent cohort instead of evaluating every feature.
+    """
+    if parent is None:
+        table_ = cohort_table(conn, table_name, cohort_features)
     else:
-        return table_name
+        table_ = refine_cohort(conn, table_name, *parent)
+    schema.store_cohort_members(conn, cohort_id, select([
+        literal(cohort_id),
+        literal(DATA_VERSION),
+        table_.c["PatientId"],
+        table_.c["year"],
+    ]).distinct())
+
+
+def find_parent_cohort(conn, table_name, cohort_features_norm):
+    """Find a materialized cohort to refine into a cohort with these features.
+
+    The parent is the stored cohort with the most features, all of which
+    are among the normalized `cohort_features_norm`. Returns the parent's
+    id and the features it lacks, or None if there is no such cohort,
+    materialization is disabled or does not apply, or the columnar engine
+    evaluates cohorts anyway.
+    """
+    if (
+            not MATERIALIZE_COHORTS
+            or columnar.ENABLED
+            or not can_materialize(conn, table_name, cohort_features_norm)
+    ):
+        return None
+    keys = {feature_key(feature): feature for feature in cohort_features_norm}
+    s = select([column("cohort_id"), column("features")])\
+        .select_from(table("cohort"))\
+        .where(column("table") == table_name)\
+        .where(column("year").is_(None))
+    candidates = []
+    for cohort_id, features in conn.execute(s):
+        parent_keys = {
+            feature_key(feature)
+            for feature in normalize_features(None, json.loads(features))
+        }
+        if parent_keys and parent_keys < set(keys):
+            candidates.append((len(parent_keys), cohort_id, parent_keys))
+    for _, cohort_id, parent_keys in sorted(candidates, key=lambda c: c[0], reverse=True):
+        if schema.is_materialized(conn, cohort_id):
+            return cohort_id, [
+                feature for key, feature in keys.items()
+                if key not in parent_keys
+            ]
+    return None
+
+
+def refine_cohort(conn, table_name, parent_id, features):
+    """Get a selectable of the parent cohort's rows matching more features.
+
+    The parent's features are not applied again, which relies on each
+    member (PatientId, year) being one row; find_parent_cohort only finds
+    parents if can_materialize holds.
+    """
+    table_ = conn.tables[table_name]
+    members = schema.select_cohort_members(conn, parent_id).alias("members")
+    return select([table_]).select_from(table_.join(members, and_(
+        table_.c["PatientId"] == members.c["PatientId"],
+        table_.c["year"] == members.c["year"],
+    ))).where(and_(*(
+        op_dict(
+            feature["feature_name"],
+            feature["feature_qualifier"],
+            table_=table_,
+        )
+        for feature in features
+    ))).alias("cohort")
+
+
+def cohort_members(conn, table_name, cohort_id, cohort_features):
+    """Get a selectable of the materialized members of a cohort.
+
+    Members are materialized on first use, and again whenever the data
+    version changes. Returns None if materialization is disabled or does
+    not apply to the cohort.
+    """
+    if cohort_id is None or not MATERIALIZE_COHORTS:
+        return None
+    if not can_materialize(conn, table_name, normalize_features(None, cohort_features)):
+        return None
+    if not schema.is_materialized(conn, cohort_id):
+        materialize_cohort(conn, table_name, cohort_id, cohort_features)
+    return schema.select_cohort_members(conn, cohort_id)
+
+
+def select_feature_matrix_key(
+        conn,
+        table_name,
+        year,
+        cohort_features,
+        cohort_year,
+        feature_a,
+        feature_b,
+        cohort_id=None,
+):
+    """Digest the arguments that determine select_feature_matrix's result."""
+    return get_digest(
+        table_name,
+        str(year),
+        feature_key(normalize_features(None, cohort_features)),
+        feature_key(normalize_feature(year, feature_a)),
+        feature_key(normalize_feature(year, feature_b)),
+    )
 
 
-def drop_cohort_view(conn, cohort_features):
-    if cohort_features:
-        conn.execute("DROP VIEW tmp")
+def load_feature_matrix(association):
+    """Restore a feature matrix read from the cache."""
+    interval = association["log_odds_ratio_95_confidence_interval"]
+    if interval is not None:
+        association["log_odds_ratio_95_confidence_interval"] = ConfidenceInterval(*interval)
+    return association
 
 
+@cached(key=select_feature_matrix_key, load=load_feature_matrix)
 def select_feature_matrix(
         conn,
         table_name,
@@ -580,109 +1008,62 @@ def select_feature_matrix(
         cohort_year,
         feature_a,
         feature_b,
+        cohort_id=None,
 ):
     """Select feature matrix."""
-    table_name = create_cohort_view(conn, table_name, cohort_features)
-
     feature_a_norm = normalize_feature(year, feature_a)
     feature_b_norm = normalize_feature(year, feature_b)
+    result = count_unique(
+        conn, table_name, year,
+        feature_a_norm["feature_name"],
+        feature_b_norm["feature_name"],
+        cohort_features=cohort_features,
+        cohort_id=cohort_id,
+    )
+    return association_from_counts(
+        result, cohort_features, feature_a_norm, feature_b_norm,
+    )
 
-    ka = feature_a_norm["feature_name"]
-    vas = feature_a_norm["feature_qualifiers"]
-    kb = feature_b_norm["feature_name"]
-    vbs = feature_b_norm["feature_qualifiers"]
-    # start_time = time.time()
-    result = count_unique(conn, table_name, year, ka, kb)
-    _ka = "0_" + ka
-    _kb = "1_" + kb
-    result = [
-        {
-            _ka: el[0],
-            _kb: el[1],
-            "count": el[2],
-        }
-        for el in result
-    ]
-    feature_matrix = [
-        [
-            get_count(result, **{
-                _ka: va,
-                _kb: vb,
-            })
-            for va in vas
-        ]
-        for vb in vbs
-    ]
-    total_cols = [
-        get_count(result, **{_ka: va}) for va in vas
-    ]
-    total_rows = [
-        get_count(result, **{_kb: vb}) for vb in vbs
-    ]
-    total = get_count(result)
-    observed = list(map(
-        lambda x: list(map(add_eps, x)),
-        feature_matrix
-    ))
-    feature_matrix2 = [
-        [
-            {
-                "frequency": cell,
-                "row_percentage": div(cell, total_rows[i]),
-                "column_percentage": div(cell, total_cols[j]),
-                "total_percentage": div(cell, total)
-            } for j, cell in enumerate(row)
-        ] for i, row in enumerate(feature_matrix)
-    ]
-    feature_a_norm_with_biolink_class = {
-        **feature_a_norm
-    }
 
-    feature_b_norm_with_biolink_class = {
-        **feature_b_norm
-    }
-    if observed:
-        chi_squared, chi_squared_p, chi_squared_dof, _ = chi2_contingency(observed, correction=False)
-        feature_matrix = np.array(feature_matrix)
-        if feature_matrix.shape == (2, 2) and not np.any(feature_matrix == 0):
-            fisher_exact_odds_ratio, fisher_exact_p = fisher_exact(feature_matrix, alternative='two-sided')
-            or_result = contingency.odds_ratio(feature_matrix, kind='sample')
-            log_odds_ratio = np.log(or_result.statistic)
-            odds_ratio_conf_interval_95 = or_result.confidence_interval(confidence_level=0.95)
-            # Calculate the log of the lower and upper bounds of the confidence interval
-            log_lb = np.log(odds_ratio_conf_interval_95[0])
-            log_ub = np.log(odds_ratio_conf_interval_95[1])
-            log_odds_ratio_conf_interval_95 = ConfidenceInterval(low=log_lb, high=log_ub)
-        else:
-            fisher_exact_odds_ratio = fisher_exact_p = log_odds_ratio = log_odds_ratio_conf_interval_95 = None
+def association_from_counts(result, cohort_features, feature_a_norm, feature_b_norm):
+    """Build the feature matrix and its statistics from grouped counts.
 
-        association = {
-            "cohort_feature": cohort_features,
-            "feature_a": feature_a_norm_with_biolink_class,
-            "feature_b": feature_b_norm_with_biolink_class,
-            "feature_matrix": feature_matrix2 if result else [],
-            "rows": [
-                {"frequency": a, "percentage": b}
-                for (a,b) in zip(total_rows, map(lambda x: div(x, total), total_rows))
-            ],
-            "columns": [
-                {"frequency": a, "percentage": b}
-                for (a,b) in zip(total_cols, map(lambda x: div(x, total), total_cols))
-            ],
-            "total": total,
-            "chi_squared_statistic": chi_squared,
-            "chi_squared_dof": chi_squared_dof,
-            "chi_squared_p": chi_squared_p,
-            "fisher_exact_odds_ratio": fisher_exact_odds_ratio,
-            "fisher_exact_p": fisher_exact_p,
-            "log_odds_ratio": log_odds_ratio,
-            "log_odds_ratio_95_confidence_interval": log_odds_ratio_conf_interval_95,
-        }
-    else:
-        association = {
+    `result` holds [value_a, value_b, count] rows as returned by
+    count_unique.
+    """
+    return associations_from_counts(
+        [result], cohort_features, feature_a_norm, [feature_b_norm],
+    )[0]
+
+
+def associations_from_counts(results, cohort_features, feature_a_norm, feature_b_norms):
+    """Build feature matrices of feature a with each feature b.
+
+    The statistics of all the matrices are computed in one batch.
+    """
+    vas = feature_a_norm["feature_qualifiers"]
+    associations = []
+    tables = []
+    for result, feature_b_norm in zip(results, feature_b_norms):
+        vbs = feature_b_norm["feature_qualifiers"]
+        feature_matrix, total_rows, total_cols, total = contingency_table(
+            result, vas, vbs,
+        )
+        tables.append(feature_matrix)
+        feature_matrix2 = [
+            [
+                {
+                    "frequency": cell,
+                    "row_percentage": div(cell, total_rows[i]),
+                    "column_percentage": div(cell, total_cols[j]),
+                    "total_percentage": div(cell, total)
+                } for j, cell in enumerate(row)
+            ] for i, row in enumerate(feature_matrix)
+        ]
+        associations.append({
             "cohort_feature": cohort_features,
-            "feature_a": feature_a_norm_with_biolink_class,
-            "feature_b": feature_b_norm_with_biolink_class,
+            "feature_a": {**feature_a_norm},
+            "feature_b": {**feature_b_norm},
             "feature_matrix": feature_matrix2 if result else [],
             "rows": [
                 {"frequency": a, "percentage": b}
@@ -693,20 +1074,105 @@ def select_feature_matrix(
                 for (a,b) in zip(total_cols, map(lambda x: div(x, total), total_cols))
             ],
             "total": total,
-            "chi_squared_statistic": None,
-            "chi_squared_dof": None,
-            "chi_squared_p": None,
-            "fisher_exact_odds_ratio": None,
-            "fisher_exact_p": None,
-            "log_odds_ratio": None,
-            "log_odds_ratio_95_confidence_interval": None
-        }
+        })
 
-    drop_cohort_view(conn, cohort_features)
+    for association, statistics in zip(associations, table_statistics(tables)):
+        association.update(statistics)
+    return associations
 
-    return association
 
+def count_values(
+        conn,
+        table_name,
+        year,
+        cohort_features,
+        cohort_year,
+        feature_names,
+        cohort_id=None,
+):
+    """Count the values of several features in one scan of the cohort.
 
+    Returns a Counter of values for each feature name.
+    """
+    cohort_features_norm = normalize_features(cohort_year, cohort_features)
+    cohort_year = cohort_year if len(cohort_features_norm) == 0 else None
+    try:
+        return cube.count_values(
+            table_name, year, cohort_features_norm, cohort_year, feature_names,
+        )
+    except columnar.Unsupported:
+        pass
+    if columnar.ENABLED:
+        try:
+            return columnar.count_values(
+                conn, table_name, year, cohort_features_norm, cohort_year, feature_names,
+            )
+        except columnar.Unsupported:
+            pass
+    table_ = cohort_table(conn, table_name, cohort_features, cohort_id)
+    if (
+        all(feature["year"] is None for feature in cohort_features_norm)
+        and cohort_members(conn, table_name, cohort_id, cohort_features) is not None
+    ):
+        # the member rows already satisfy the cohort features
+        cohort_features_norm = []
+    one_row_per_year = unique_patient_years(conn, table_name)
+
+    def count(conn, names):
+        """Count the values of some of the features."""
+        gen_table, _, _ = generate_tables_from_features(
+            table_,
+            cohort_features_norm,
+            cohort_year,
+            [(feature_name, year) for feature_name in names],
+            one_row_per_year=one_row_per_year,
+        )
+        counters = [Counter() for _ in names]
+        result = conn.execute(
+            select([column(feature_name) for feature_name in names])
+            .select_from(gen_table)
+        )
+        while rows := result.fetchmany(FETCH_SIZE):
+            for counter, values in zip(counters, zip(*rows)):
+                counter.update(values)
+        return zip(names, counters)
+
+    # one scan per worker, each counting a share of the features
+    chunk_size = min(
+        MAX_ENTRIES_PER_ROW,
+        max(-(-len(feature_names) // fanout.workers(conn)), 1),
+    )
+    counts = {}
+    for chunk_counts in fanout.fan_out(conn, count, [
+        feature_names[i:i + chunk_size]
+        for i in range(0, len(feature_names), chunk_size)
+    ]):
+        counts.update(chunk_counts)
+    return counts
+
+
+def select_feature_count_all_values_key(
+        conn,
+        table_name,
+        year,
+        cohort_features,
+        cohort_year,
+        feature_name,
+        levels,
+        cohort_id=None,
+):
+    """Digest the arguments that determine select_feature_count_all_values's result."""
+    return get_digest(
+        table_name,
+        str(year),
+        feature_key(normalize_features(cohort_year, cohort_features)),
+        str(cohort_year),
+        feature_name,
+        feature_key(levels),
+    )
+
+
+@cached(key=select_feature_count_all_values_key)
 def select_feature_count_all_values(
         conn,
         table_name,
@@ -714,22 +1180,25 @@ def select_feature_count_all_values(
         cohort_features,
         cohort_year,
         feature_name,
-        levels
+        levels,
+        cohort_id=None,
 ):
     """Select feature count."""
-    cohort_features_norm = normalize_features(cohort_year, cohort_features)
-    cohort_year = cohort_year if len(cohort_features_norm) == 0 else None
-    gen_table, _, _ = generate_tables_from_features(
+    counts = count_values(
+        conn,
         table_name,
-        cohort_features_norm,
+        year,
+        cohort_features,
         cohort_year,
-        [(feature_name, year)],
+        [feature_name],
+        cohort_id=cohort_id,
     )
-    sqlcolumn = column(feature_name)
-    result = conn.execute(select([sqlcolumn, func.count()]).select_from(gen_table).group_by(sqlcolumn)).fetchall()
-    values = defaultdict(int)
-    for value, count in result:
-        values[value] = count
+    return feature_count(feature_name, year, counts[feature_name], levels)
+
+
+def feature_count(feature_name, year, counts, levels):
+    """Summarize the value counts of a feature by its levels."""
+    values = defaultdict(int, counts)
     total = sum(values.values())
     levels = list(levels)
 
@@ -815,47 +1284,47 @@ def get_feature_levels(feature, year=None, cohort_feat_dict=None):
 
 def apply_correction(ret, correction=None):
     """Apply p-value correction."""
+    return apply_corrections([ret], correction)[0]
+
+
+def apply_corrections(rets, correction=None):
+    """Apply p-value correction across a family of associations.
+
+    All of the p-values are corrected together, in one call.
+    """
     if correction is not None:
         method = correction["method"]
         alpha = correction.get("alpha", 1)
-        if ret["chi_squared_p"] is None:
+        tested = [ret for ret in rets if ret["chi_squared_p"] is not None]
+        for ret in rets:
             ret["chi_squared_p_corrected"] = None
-            return ret
-        rsp = [ret["chi_squared_p"]]
-        _, pvals, _, _ = multipletests(rsp, alpha, method)
-        ret["chi_squared_p_corrected"] = pvals[0]
-    return ret
+        if tested:
+            rsp = [ret["chi_squared_p"] for ret in tested]
+            pvals = correct_p_values(rsp, alpha, method)
+            for ret, pval in zip(tested, pvals):
+                ret["chi_squared_p_corrected"] = pval
+    return rets
 
 
 class PValueError(Exception):
     """p-value is too high."""
 
 
-def select_feature_association(
-        conn,
-        table_name,
-        year,
-        cohort_features,
-        cohort_year,
-        feature_a,
-        maximum_p_value,
-        feature_b,
-        correction,
-):
-    """Select feature association."""
-    ret = apply_correction(
-        select_feature_matrix(
-            conn, table_name, year,
-            cohort_features, cohort_year, feature_a, feature_b,
-        ),
-        correction,
-    )
-
+def check_p_value(ret, maximum_p_value):
+    """Raise PValueError if the (corrected) p-value is too high."""
     if (pval := ret.get("chi_squared_p_corrected", ret.get("chi_squared_p", None))) is None or pval > maximum_p_value:
         raise PValueError(f"chi_squared_p {pval} > {maximum_p_value}")
     return ret
 
 
+def select_feature_association(association, maximum_p_value, correction):
+    """Apply p-value correction and filter by the maximum p-value."""
+    return check_p_value(
+        apply_correction(association, correction),
+        maximum_p_value,
+    )
+
+
 def select_associations_to_all_features(
         conn,
         table,
@@ -866,6 +1335,35 @@ def select_associations_to_all_features(
         feature_filter_b: Callable[[str], bool] = lambda x: True,
         correction=None,
 ):
+    """Select associations of features a with features b."""
+    return list(iter_associations_to_all_features(
+        conn,
+        table,
+        year,
+        cohort_id,
+        feature_filter_a,
+        maximum_p_value,
+        feature_filter_b=feature_filter_b,
+        correction=correction,
+    ))
+
+
+def iter_associations_to_all_features(
+        conn,
+        table,
+        year,
+        cohort_id,
+        feature_filter_a: Union[Callable[[str], bool], Dict[str, Any]],
+        maximum_p_value,
+        feature_filter_b: Callable[[str], bool] = lambda x: True,
+        correction=None,
+):
+    """Iterate over associations of features a with features b.
+
+    The cohort is looked up before this returns. Without a correction,
+    associations are computed as they are iterated over; with one, they
+    are all computed first, since the correction needs every p-value.
+    """
     cohort_meta = get_features_by_id(conn, table, cohort_id)
     if cohort_meta is None:
         raise ValueError("Input cohort_id invalid. Please try again.")
@@ -892,30 +1390,69 @@ def select_associations_to_all_features(
         for feature_name in filter(feature_filter_b, get_features(conn, table))
     ]
 
-    associations = []
     done = set()
-    for feature_a, feature_b in product(feature_as, feature_bs):
-        hashable = tuple(sorted((feature_a["feature_name"], feature_b["feature_name"])))
-        if hashable in done:
-            continue
-        done.add(hashable)
+    feature_pairs = []
+    for feature_a in feature_as:
+        pairs = []
+        for feature_b in feature_bs:
+            hashable = tuple(sorted((feature_a["feature_name"], feature_b["feature_name"])))
+            if hashable in done:
+                continue
+            done.add(hashable)
+            pairs.append(feature_b)
+        if pairs:
+            feature_pairs.append((feature_a, pairs))
+
+    # materialize the cohort, if needed, before fanning out
+    cohort_members(conn, table, cohort_id, cohort_features)
+
+    def associate(conn, feature_pair):
+        """Compute the associations of feature a, reading the cohort once."""
+        feature_a, pairs = feature_pair
+        results = count_unique_pairs(
+            conn,
+            table,
+            year,
+            feature_a["feature_name"],
+            [feature_b["feature_name"] for feature_b in pairs],
+            cohort_features=cohort_features,
+            cohort_id=cohort_id,
+        )
+        return associations_from_counts(
+            [results[feature_b["feature_name"]] for feature_b in pairs],
+            cohort_features,
+            normalize_feature(year, feature_a),
+            [normalize_feature(year, feature_b) for feature_b in pairs],
+        )
+
+    # as many feature a's at a time as there are connections to fan out to
+    batch_size = fanout.workers(conn)
+    # a streamed response is iterated after the handler has returned, so
+    # each batch runs in the handler's context, which has its client's
+    # disconnect check; that stops the work once the client is gone
+    context = copy_context()
+    associations = (
+        association
+        for i in range(0, len(feature_pairs), batch_size)
+        for associations in context.run(
+            fanout.fan_out, conn, associate, feature_pairs[i:i + batch_size],
+        )
+        for association in associations
+    )
+    if correction is not None:
+        # correct across every association in the response, then filter
+        associations = apply_corrections(list(associations), correction)
+    return select_by_p_value(associations, maximum_p_value)
+
+
+def select_by_p_value(associations, maximum_p_value):
+    """Yield the associations whose (corrected) p-value is low enough."""
+    for association in associations:
         try:
-            associations.append(select_feature_association(
-                conn,
-                table,
-                year,
-                cohort_features,
-                cohort_year,
-                feature_a,
-                maximum_p_value,
-                feature_b,
-                correction,
-            ))
+            yield check_p_value(association, maximum_p_value)
         except PValueError:
             continue
 
-    return associations
-
 
 def validate_range(conn, table_name, feature):
     feature_name = feature["feature_name"]
@@ -1028,6 +1565,43 @@ def compute_multivariate_table(conn, table_name, year, cohort_id, feature_variab
     if cohort_meta is None:
         raise ValueError("Input cohort_id invalid. Please try again.")
     cohort_features, cohort_year = cohort_meta
+    return multivariate_table(
+        conn,
+        table_name,
+        year,
+        cohort_features,
+        feature_variables,
+        cohort_id=cohort_id,
+    )
+
+
+def multivariate_table_key(
+        conn,
+        table_name,
+        year,
+        cohort_features,
+        feature_variables,
+        cohort_id=None,
+):
+    """Digest the arguments that determine multivariate_table's result."""
+    return get_digest(
+        table_name,
+        str(year),
+        feature_key(normalize_features(None, cohort_features)),
+        feature_key(feature_variables),
+    )
+
+
+@cached(key=multivariate_table_key)
+def multivariate_table(
+        conn,
+        table_name,
+        year,
+        cohort_features,
+        feature_variables,
+        cohort_id=None,
+):
+    """Compute the frequency of each combination of feature levels."""
     feat_len = len(feature_variables)
     if feat_len < 3:
         raise HTTPException(status_code=400, detail="At least three feature variables must be provided "
@@ -1102,22 +1676,15 @@ def compute_multivariate_table(conn, table_name, year, cohort_id, feature_variab
         feat_constraint_list = more_constraint_list
 
     # compute frequency for each feature constraint
-    if cohort_features:
-        # compute frequency on the cohort view
-        table_name = create_cohort_view(conn, table_name, cohort_features)
-
     if len(feat_constraint_list) > 0:
         columns = list(feat_constraint_list[0].keys())
-        result = count_unique(conn, table_name, year, *columns)
-        result = [
-            {"count": el[-1],
-             **{col: el[i] for i, col in enumerate(columns)}
-             }
-            for el in result
-        ]
-        for fc in feat_constraint_list:
-            fc['frequency'] = get_count(result, **fc)
+        result = count_unique(
+            conn, table_name, year, *columns,
+            cohort_features=cohort_features,
+            cohort_id=cohort_id,
+        )
+        frequencies = get_frequencies(result, columns, feat_constraint_list)
+        for fc, frequency in zip(feat_constraint_list, frequencies):
+            fc['frequency'] = frequency
 
-    if cohort_features:
-        drop_cohort_view(conn, cohort_features)
     return feat_constraint_list
@@ -0,0 +1,166 @@
+"""Contingency table statistics, computed for many tables at once."""
+from collections import defaultdict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+import os
+from threading import Lock
+
+import numpy as np
+from scipy.special import ndtri
+from scipy.stats import chi2, fisher_exact
+from statsmodels.stats.multitest import multipletests
+
+# processes computing statistics for each API worker; 0 computes them in-process
+STATS_PROCESSES = int(os.environ.get("STATS_PROCESSES", "0"))
+# smaller batches are not worth sending to another process
+STATS_PROCESS_MIN_TABLES = int(os.environ.get("STATS_PROCESS_MIN_TABLES", "64"))
+
+eps = np.finfo(float).eps
+ConfidenceInterval = namedtuple('ConfidenceInterval', ['low', 'high'])
+
+NO_STATISTICS = {
+    "chi_squared_statistic": None,
+    "chi_squared_dof": None,
+    "chi_squared_p": None,
+    "fisher_exact_odds_ratio": None,
+    "fisher_exact_p": None,
+    "log_odds_ratio": None,
+    "log_odds_ratio_95_confidence_interval": None,
+}
+
+
+def chi_squared(observed):
+    """Pearson's chi-squared test of independence for stacked tables.
+
+    `observed` has shape (tables, rows, columns). Matches
+    scipy.stats.chi2_contingency without Yates' correction.
+    """
+    _, n_rows, n_cols = observed.shape
+    dof = (n_rows - 1) * (n_cols - 1)
+    if dof == 0:
+        return np.zeros(len(observed)), dof, np.ones(len(observed))
+    expected = (
+        observed.sum(axis=2, keepdims=True)
+        * observed.sum(axis=1, keepdims=True)
+        / observed.sum(axis=(1, 2), keepdims=True)
+    )
+    statistic = ((observed - expected) ** 2 / expected).sum(axis=(1, 2))
+    return statistic, dof, chi2.sf(statistic, dof)
+
+
+def log_odds_ratios(counts, confidence_level=0.95):
+    """Sample log odds ratios and their confidence intervals.
+
+    `counts` has shape (tables, 2, 2) and no zeros. Matches the log of
+    scipy.stats.contingency.odds_ratio(kind="sample") and of its
+    confidence interval.
+    """
+    log_odds_ratio = np.log(
+        counts[:, 0, 0] * counts[:, 1, 1]
+        / (counts[:, 0, 1] * counts[:, 1, 0])
+    )
+    se = np.sqrt((1 / counts).sum(axis=(1, 2)))
+    z = ndtri(0.5 * confidence_level + 0.5)
+    return log_odds_ratio, log_odds_ratio - z * se, log_odds_ratio + z * se
+
+
+_pool = None
+_pool_lock = Lock()
+
+
+def get_pool():
+    """Get the process pool, starting it on first use.
+
+    Processes are spawned rather than forked, since the API process is
+    multithreaded.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=STATS_PROCESSES,
+                mp_context=get_context("spawn"),
+            )
+        return _pool
+
+
+def offload(n):
+    """Determine whether to compute statistics of n things in the pool."""
+    return STATS_PROCESSES > 0 and n >= STATS_PROCESS_MIN_TABLES
+
+
+def table_statistics(tables):
+    """Compute the statistics of each contingency table.
+
+    Large batches are split across the process pool, if there is one, so
+    that the computation does not hold this process's GIL.
+    """
+    if not offload(len(tables)):
+        return compute_table_statistics(tables)
+    chunk_size = -(-len(tables) // STATS_PROCESSES)
+    chunks = get_pool().map(compute_table_statistics, [
+        tables[i:i + chunk_size]
+        for i in range(0, len(tables), chunk_size)
+    ])
+    return [statistics for chunk in chunks for statistics in chunk]
+
+
+def correct_p_values(p_values, alpha, method):
+    """Correct p-values for multiple testing, in the process pool if large."""
+    if offload(len(p_values)):
+        return get_pool().submit(_correct_p_values, p_values, alpha, method).result()
+    return _correct_p_values(p_values, alpha, method)
+
+
+def _correct_p_values(p_values, alpha, method):
+    """Correct p-values for multiple testing."""
+    _, corrected, _, _ = multipletests(p_values, alpha, method)
+    return [float(p_value) for p_value in corrected]
+
+
+def compute_table_statistics(tables):
+    """Compute the statistics of each contingency table.
+
+    `tables` are lists of rows of counts. Tables with the same shape are
+    stacked and tested together; Fisher's exact test runs only on the 2 x 2
+    tables without zeros. Returns one dict of statistics per table.
+    """
+    results = [None] * len(tables)
+    shapes = defaultdict(list)
+    for i, table in enumerate(tables):
+        if not table:
+            results[i] = dict(NO_STATISTICS)
+            continue
+        table = np.asarray(table, dtype=float)
+        if table.size == 0:
+            raise ValueError("No data; `observed` has size 0.")
+        shapes[table.shape].append(i)
+
+    for shape, indices in shapes.items():
+        counts = np.stack([np.asarray(tables[i], dtype=float) for i in indices])
+        statistic, dof, p = chi_squared(counts + eps)
+        for i, index in enumerate(indices):
+            results[index] = {
+                **NO_STATISTICS,
+                "chi_squared_statistic": float(statistic[i]),
+                "chi_squared_dof": int(dof),
+                "chi_squared_p": float(p[i]),
+            }
+        if shape != (2, 2):
+            continue
+        nonzero = np.all(counts != 0, axis=(1, 2))
+        if not nonzero.any():
+            continue
+        log_odds_ratio, log_low, log_high = log_odds_ratios(counts[nonzero])
+        for i, index in enumerate(np.asarray(indices)[nonzero]):
+            odds_ratio, fisher_p = fisher_exact(tables[index], alternative='two-sided')
+            results[index].update({
+                "fisher_exact_odds_ratio": float(odds_ratio),
+                "fisher_exact_p": float(fisher_p),
+                "log_odds_ratio": float(log_odds_ratio[i]),
+                "log_odds_ratio_95_confidence_interval": ConfidenceInterval(
+                    low=float(log_low[i]),
+                    high=float(log_high[i]),
+                ),
+            })
+    return results
@@ -3,12 +3,12 @@ import os
 import json
 from typing import Dict, Optional, List
 
-from fastapi import APIRouter, Body, Depends, Security, HTTPException
+from fastapi import APIRouter, Body, Depends, Header, Security, HTTPException
 from fastapi.security.api_key import APIKeyQuery, APIKeyCookie, APIKeyHeader, APIKey
 from starlette.status import HTTP_403_FORBIDDEN
 
 from .dependencies import get_db
-from .features import sql
+from .features import cache, columnar, fanout, sql
 from .features.sql import validate_range, validate_feature_value_in_table_column_for_equal_operator
 from .features.config import get_config_path
 from .models import (
@@ -17,7 +17,7 @@ from .models import (
     AllFeaturesAssociation, AllFeaturesAssociation2,
     AddNameById,
 )
-from .utils import to_qualifiers, to_qualifiers2, associations_have_feature_matrices
+from .utils import NDJSON, accepts, to_qualifiers, to_qualifiers2, associations_have_feature_matrices
 
 
 API_KEY = os.environ.get("API_KEY")
@@ -32,6 +32,17 @@ def validate_table(table_name):
         raise HTTPException(400, f"Invalid table '{table_name}'")
 
 
+def validate_features(conn, table_name, features):
+    """Validate the values of features, querying for them in parallel."""
+    fanout.fan_out(
+        conn,
+        lambda conn, feature: validate_feature_value_in_table_column_for_equal_operator(
+            conn, table_name, feature,
+        ),
+        features,
+    )
+
+
 if API_KEY is None:
     async def get_api_key():
         return None
@@ -234,8 +245,7 @@ def feature_association(
     feature_a = to_qualifiers(obj["feature_a"])
     feature_b = to_qualifiers(obj["feature_b"])
     try:
-        validate_feature_value_in_table_column_for_equal_operator(conn, table, feature_a)
-        validate_feature_value_in_table_column_for_equal_operator(conn, table, feature_b)
+        validate_features(conn, table, [feature_a, feature_b])
     except RuntimeError as ex:
         return {"return value": str(ex)}
 
@@ -253,6 +263,7 @@ def feature_association(
             cohort_year,
             feature_a,
             feature_b,
+            cohort_id=cohort_id,
         )
         if not return_value['feature_matrix']:
             return_value = "Empty query result returned. Please try again"
@@ -296,8 +307,7 @@ def feature_association2(
     feature_a = to_qualifiers2(obj["feature_a"])
     feature_b = to_qualifiers2(obj["feature_b"])
     try:
-        validate_feature_value_in_table_column_for_equal_operator(conn, table, feature_a)
-        validate_feature_value_in_table_column_for_equal_operator(conn, table, feature_b)
+        validate_features(conn, table, [feature_a, feature_b])
     except RuntimeError as ex:
         return {"return value": str(ex)}
 
@@ -320,6 +330,7 @@ def feature_association2(
             cohort_year,
             feature_a,
             feature_b,
+            cohort_id=cohort_id,
         )
         if not return_value['feature_matrix']:
             return_value = "Empty query result returned. Please try again"
@@ -343,6 +354,8 @@ def associations_to_all_features(
             ...,
             example=ASSOCIATIONS_TO_ALL_FEATURES_EXAMPLE,
         ),
+        stream: bool = False,
+        accept: Optional[str] = Header(None),
         conn=Depends(get_db),
         api_key: APIKey = Depends(get_api_key),
 ) -> Dict:
@@ -358,7 +371,9 @@ def associations_to_all_features(
     when selected, the study period year. Note also that the example query 
     may need to be tailored to the ICEES+ instance by, for example, 
     selecting different feature variables (see linked-out documentation in 
-    upper left corner).
+    upper left corner). With `stream=true` or an `Accept:
+    application/x-ndjson` header, the terms and conditions and then each
+    association are streamed as newline-delimited JSON.
     """
     validate_table(table)
     feature = to_qualifiers(obj["feature"])
@@ -369,7 +384,7 @@ def associations_to_all_features(
 
     maximum_p_value = obj.get("maximum_p_value", 1)
     correction = obj.get("correction")
-    return_value = sql.select_associations_to_all_features(
+    associations = sql.iter_associations_to_all_features(
         conn,
         table,
         year,
@@ -378,6 +393,9 @@ def associations_to_all_features(
         maximum_p_value,
         correction=correction,
     )
+    if stream or accepts(accept, NDJSON):
+        return {"return value": associations}
+    return_value = list(associations)
 
     if associations_have_feature_matrices(return_value):
         return {"return value": return_value}
@@ -401,6 +419,8 @@ def associations_to_all_features2(
             ...,
             example=ASSOCIATIONS_TO_ALL_FEATURES2_EXAMPLE,
         ),
+        stream: bool = False,
+        accept: Optional[str] = Header(None),
         conn=Depends(get_db),
         api_key: APIKey = Depends(get_api_key),
 ) -> Dict:
@@ -417,7 +437,9 @@ def associations_to_all_features2(
     study period year. Note also that the example query may need to be 
     tailored to the ICEES+ instance by, for example, selecting 
     different feature variables (see linked-out documentation in 
-    upper-left corner).
+    upper-left corner). With `stream=true` or an `Accept:
+    application/x-ndjson` header, the terms and conditions and then each
+    association are streamed as newline-delimited JSON.
     """
     validate_table(table)
     feature = to_qualifiers2(obj["feature"])
@@ -431,7 +453,7 @@ def associations_to_all_features2(
         validate_range(conn, table, feature)
     maximum_p_value = obj["maximum_p_value"]
     correction = obj.get("correction")
-    return_value = sql.select_associations_to_all_features(
+    associations = sql.iter_associations_to_all_features(
         conn,
         table,
         year,
@@ -440,6 +462,9 @@ def associations_to_all_features2(
         maximum_p_value,
         correction=correction,
     )
+    if stream or accepts(accept, NDJSON):
+        return {"return value": associations}
+    return_value = list(associations)
     if associations_have_feature_matrices(return_value):
         return {"return value": return_value}
     else:
@@ -473,11 +498,6 @@ def features(
     else:
         feature_list = sql.get_features(conn, table)
         cohort_features, cohort_year = cohort_meta
-        # compute frequency for each feature constraint
-        if cohort_features:
-            # compute frequency on the cohort view
-            table = sql.create_cohort_view(conn, table, cohort_features)
-
         return_value = sql.get_cohort_features(
             conn,
             table,
@@ -485,14 +505,51 @@ def features(
             year,
             cohort_features,
             cohort_year,
+            cohort_id=cohort_id,
         )
 
-        if cohort_features:
-            sql.drop_cohort_view(conn, cohort_features)
-
     return {"return value": return_value}
 
 
+@ROUTER.post(
+    "/metadata/refresh",
+    response_model=Dict,
+)
+def refresh_metadata(
+        conn=Depends(get_db),
+        api_key: APIKey = Depends(get_api_key),
+) -> Dict:
+    """Refresh table metadata.
+
+    Table metadata is reflected from the database once per process and
+    shared by all requests. Call this after the database schema changes
+    (e.g. after new feature columns are loaded) so that the service
+    picks up the new tables and columns. In-memory copies of the
+    feature tables (see ICEES_ENGINE) are reloaded on next use.
+
+    Only the process serving this request is refreshed. With several
+    worker processes, restart the service instead.
+    """
+    tables = conn.refresh_tables()
+    columnar.STORE.clear(conn)
+    return {"return value": {"tables": sorted(tables.keys())}}
+
+
+@ROUTER.get(
+    "/cache/stats",
+    response_model=Dict,
+)
+def cache_stats(
+        api_key: APIKey = Depends(get_api_key),
+) -> Dict:
+    """Get result cache statistics.
+
+    Returns the hit, miss and eviction counts of this process's result
+    cache, per tier ("local" or "redis") and per endpoint.
+    """
+    return {"return value": cache.STATS.as_list()}
+
+
 @ROUTER.get(
     "/bins",
     response_model=Dict,
@@ -1,4 +1,51 @@
 """Utilities."""
+from fastapi.encoders import jsonable_encoder
+import numpy as np
+import orjson
+
+NDJSON = "application/x-ndjson"
+
+
+def accepts(accept, media_type) -> bool:
+    """Determine whether an Accept header lists a media type.
+
+    Parameters, such as charset, are ignored, except that a quality of 0
+    refuses the type. Wildcards do not count.
+    """
+    for media_range in (accept or "").split(","):
+        name, *params = media_range.split(";")
+        if name.strip().lower() != media_type:
+            continue
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    if float(value) == 0:
+                        break
+                except ValueError:
+                    pass
+        else:
+            return True
+    return False
+
+
+def json_default(obj):
+    """Convert what orjson cannot serialize itself."""
+    if isinstance(obj, tuple):
+        # e.g. ConfidenceInterval
+        return list(obj)
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return jsonable_encoder(obj)
+
+
+def to_json(content) -> bytes:
+    """Serialize to JSON in one pass, with null for NaNs."""
+    return orjson.dumps(
+        content,
+        default=json_default,
+        option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS,
+    )
 
 
 def opposite(qualifier):
@@ -1,4 +1,7 @@
 """Test API."""
+import json
+
+from fastapi import Request
 from fastapi.testclient import TestClient
 import pytest
 
@@ -237,3 +240,127 @@ def test_associations_to_all_features_with_correction_with_alpha():
     resp_json = resp.json()
     assert "return value" in resp_json
     assert isinstance(resp_json["return value"], list)
+
+
+@load_data(
+    APP,
+    """
+        PatientId,year,AgeStudyStart,Albuterol,AvgDailyPM2.5Exposure,EstResidentialDensity,AsthmaDx
+        varchar(255),int,int,varchar(255),int,int,int
+        1,2010,2,0,1,0,1
+        2,2010,2,1,1,0,1
+        3,2010,2,1,1,0,0
+        4,2010,2,0,2,1,1
+        5,2010,2,1,2,0,1
+        6,2010,2,1,2,1,0
+        7,2010,3,0,3,0,1
+        8,2010,3,1,3,1,0
+        9,2010,3,1,3,0,1
+        10,2010,3,0,4,1,0
+        11,2010,3,1,4,0,1
+        12,2010,3,1,4,1,0
+    """,
+    """
+        cohort_id,size,features,table,year
+        COHORT:1,12,"{}",patient,2010
+    """
+)
+def test_associations_to_all_features_correction_across_family():
+    """Test that the correction sees every p-value in the response."""
+    cohort_id = "COHORT:1"
+    atafdata = {
+        "feature": {
+            "AgeStudyStart": {
+                "operator": "=",
+                "value": 2
+            }
+        },
+        "maximum_p_value": 1
+    }
+    resp = testclient.post(
+        f"/{table}/cohort/{cohort_id}/associations_to_all_features",
+        json=atafdata,
+    )
+    uncorrected = resp.json()["return value"]
+    atafdata["correction"] = {"method": "bonferroni"}
+    resp = testclient.post(
+        f"/{table}/cohort/{cohort_id}/associations_to_all_features",
+        json=atafdata,
+    )
+    corrected = resp.json()["return value"]
+    assert len(corrected) == len(uncorrected) > 1
+    for association, expected in zip(corrected, uncorrected):
+        assert association["chi_squared_p_corrected"] == pytest.approx(
+            min(1, expected["chi_squared_p"] * len(uncorrected))
+        )
+
+
+@load_data(
+    APP,
+    """
+        PatientId,year,AgeStudyStart,Albuterol,AvgDailyPM2.5Exposure,EstResidentialDensity,AsthmaDx
+        varchar(255),int,int,varchar(255),int,int,int
+        1,2010,2,0,1,0,1
+        2,2010,2,1,1,0,1
+        3,2010,2,1,1,0,0
+        4,2010,2,0,2,1,1
+        5,2010,2,1,2,0,1
+        6,2010,2,1,2,1,0
+        7,2010,3,0,3,0,1
+        8,2010,3,1,3,1,0
+        9,2010,3,1,3,0,1
+        10,2010,3,0,4,1,0
+        11,2010,3,1,4,0,1
+        12,2010,3,1,4,1,0
+    """,
+    """
+        cohort_id,size,features,table,year
+        COHORT:1,12,"{}",patient,2010
+    """
+)
+def test_associations_to_all_features_stream(monkeypatch):
+    """Test streaming associations as newline-delimited JSON."""
+    cohort_id = "COHORT:1"
+    atafdata = {
+        "feature": {
+            "AgeStudyStart": {
+                "operator": "=",
+                "value": 2
+            }
+        },
+        "maximum_p_value": 1
+    }
+    resp = testclient.post(
+        f"/{table}/cohort/{cohort_id}/associations_to_all_features",
+        json=atafdata,
+    )
+    expected = resp.json()
+    for kwargs in (
+            {"params": {"stream": True}},
+            {"headers": {"Accept": "application/x-ndjson"}},
+            {"headers": {"Accept": "application/x-ndjson, */*"}},
+            {"headers": {"Accept": "application/json;q=0.5, application/x-ndjson; charset=utf-8"}},
+    ):
+        resp = testclient.post(
+            f"/{table}/cohort/{cohort_id}/associations_to_all_features",
+            json=atafdata,
+            **kwargs,
+        )
+        assert resp.headers["content-type"] == "application/x-ndjson"
+        lines = [json.loads(line) for line in resp.text.splitlines()]
+        assert lines[0] == {"terms and conditions": expected["terms and conditions"]}
+        assert lines[1:] == expected["return value"]
+
+    # a client that disconnects gets no more associations computed
+    async def is_disconnected(self):
+        return True
+
+    monkeypatch.setattr(Request, "is_disconnected", is_disconnected)
+    resp = testclient.post(
+        f"/{table}/cohort/{cohort_id}/associations_to_all_features",
+        json=atafdata,
+        params={"stream": True},
+    )
+    assert [json.loads(line) for line in resp.text.splitlines()] == [
+        {"terms and conditions": expected["terms and conditions"]},
+    ]
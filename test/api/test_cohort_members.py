@@ -0,0 +1,178 @@
+"""Test materialized cohort membership."""
+from functools import wraps
+import json
+
+from fastapi.testclient import TestClient
+
+from icees_api.app import APP
+from icees_api.dependencies import get_db
+from icees_api.features import schema, sql
+
+from ..util import get_db_, load_data, escape_quotes
+
+testclient = TestClient(APP)
+table = "patient"
+cohort_features = {
+    "AsthmaDx": {"operator": "=", "value": 1},
+}
+data = """
+    PatientId,year,AgeStudyStart,Albuterol,AvgDailyPM2.5Exposure,EstResidentialDensity,AsthmaDx
+    varchar(255),int,varchar(255),varchar(255),int,int,int
+    1,2010,0-2,0,1,0,1
+    1,2011,0-2,1,2,0,1
+    2,2010,0-2,1,1,0,1
+    2,2011,0-2,>1,1,0,0
+    3,2010,0-2,>1,1,0,1
+    4,2010,0-2,0,2,0,1
+    5,2010,0-2,1,2,0,1
+    6,2010,0-2,>1,2,0,0
+    7,2010,0-2,0,3,0,1
+    8,2010,0-2,1,3,0,1
+    9,2010,0-2,>1,3,0,1
+    10,2010,0-2,0,4,0,1
+    11,2010,0-2,1,4,0,1
+    12,2010,0-2,>1,4,0,1
+"""
+cohort_data = """
+    cohort_id,size,features,table,year
+    COHORT:1,11,"{0}",patient,
+""".format(escape_quotes(json.dumps(cohort_features, sort_keys=True)))
+
+
+def load_data_and_cohort(data):
+    """Create decorator loading data and COHORT:1, of no year.
+
+    CSV cohort data cannot hold a NULL year.
+    """
+    async def get_db_with_cohort():
+        async for conn in get_db_(data, ""):
+            sql.insert_cohort(
+                conn, "COHORT:1", 11, json.dumps(cohort_features, sort_keys=True),
+                table, None,
+            )
+            yield conn
+
+    def decorator(fcn):
+        @wraps(fcn)
+        def wrapper(*args, **kwargs):
+            APP.dependency_overrides[get_db] = get_db_with_cohort
+            fcn(*args, **kwargs)
+            APP.dependency_overrides = {}
+        return wrapper
+    return decorator
+
+
+@load_data_and_cohort(data)
+def test_materialized_features(monkeypatch):
+    """Test that materialized cohorts give the same feature counts."""
+    cohort_id = "COHORT:1"
+    expected = testclient.get(f"/{table}/cohort/{cohort_id}/features").json()
+    age_counts = expected["return value"][0]["feature_matrix"]
+    # patient 1 matches in both years
+    assert age_counts[0]["frequency"] == 14
+
+    stored = []
+    store_cohort_members = schema.store_cohort_members
+
+    def spy(conn, cohort_id, rows):
+        stored.append(cohort_id)
+        return store_cohort_members(conn, cohort_id, rows)
+
+    monkeypatch.setattr(schema, "store_cohort_members", spy)
+    monkeypatch.setattr(sql, "MATERIALIZE_COHORTS", True)
+    resp = testclient.get(f"/{table}/cohort/{cohort_id}/features")
+    assert resp.json() == expected
+    assert stored == [cohort_id]
+
+
+@load_data(APP, data, cohort_data.replace("patient,", "patient,2010"))
+def test_materialized_features_cohort_year(monkeypatch):
+    """Test materialized cohorts with a cohort year."""
+    cohort_id = "COHORT:1"
+    expected = testclient.get(f"/{table}/cohort/{cohort_id}/features").json()
+    monkeypatch.setattr(sql, "MATERIALIZE_COHORTS", True)
+    resp = testclient.get(f"/{table}/cohort/{cohort_id}/features")
+    assert resp.json() == expected
+
+
+@load_data(APP, data, cohort_data)
+def test_materialized_feature_association(monkeypatch):
+    """Test that materialized cohorts give the same feature matrix."""
+    cohort_id = "COHORT:1"
+    atafdata = {
+        "feature_a": {
+            "feature_name": "Albuterol",
+            "feature_qualifiers": [
+                {"operator": "=", "value": "0"},
+                {"operator": "=", "value": "1"},
+                {"operator": "=", "value": ">1"},
+            ]
+        },
+        "feature_b": {
+            "feature_name": "AvgDailyPM2.5Exposure",
+            "feature_qualifiers": [
+                {"operator": "<", "value": 3},
+                {"operator": ">=", "value": 3},
+            ]
+        },
+    }
+    expected = testclient.post(
+        f"/{table}/cohort/{cohort_id}/feature_association2",
+        json=atafdata,
+    ).json()
+    assert expected["return value"]["total"] == 12
+    monkeypatch.setattr(sql, "MATERIALIZE_COHORTS", True)
+    resp = testclient.post(
+        f"/{table}/cohort/{cohort_id}/feature_association2",
+        json=atafdata,
+    )
+    assert resp.json() == expected
+
+
+@load_data(APP, data)
+def test_materialized_cohort_size(monkeypatch):
+    """Test creating a materialized cohort."""
+    monkeypatch.setattr(sql, "MATERIALIZE_COHORTS", True)
+    resp = testclient.post(f"/{table}/cohort", json=cohort_features)
+    assert resp.json()["return value"] == {
+        "cohort_id": "COHORT:1",
+        "size": 11,
+    }
+
+
+# patient 1 has another 2010 row, which is not in the cohort
+@load_data_and_cohort(data + "1,2010,0-2,>1,4,0,0\n")
+def test_duplicate_patient_years(monkeypatch):
+    """Test that cohorts are not materialized as patient-years that partly match."""
+    cohort_id = "COHORT:1"
+    atafdata = {
+        "feature_a": {
+            "feature_name": "Albuterol",
+            "feature_qualifiers": [
+                {"operator": "=", "value": "0"},
+                {"operator": "=", "value": "1"},
+                {"operator": "=", "value": ">1"},
+            ]
+        },
+        "feature_b": {
+            "feature_name": "AvgDailyPM2.5Exposure",
+            "feature_qualifiers": [
+                {"operator": "<", "value": 3},
+                {"operator": ">=", "value": 3},
+            ]
+        },
+    }
+    expected_features = testclient.get(f"/{table}/cohort/{cohort_id}/features").json()
+    expected_association = testclient.post(
+        f"/{table}/cohort/{cohort_id}/feature_association2",
+        json=atafdata,
+    ).json()
+    assert expected_association["return value"]["total"] == 12
+
+    monkeypatch.setattr(sql, "MATERIALIZE_COHORTS", True)
+    assert testclient.get(f"/{table}/cohort/{cohort_id}/features").json() \
+        == expected_features
+    assert testclient.post(
+        f"/{table}/cohort/{cohort_id}/feature_association2",
+        json=atafdata,
+    ).json() == expected_association
@@ -176,3 +176,66 @@ def test_feature_association2_explicit_check_coverage_is_full():
     resp_json = resp.json()
     assert "return value" in resp_json
     do_verify_feature_matrix_response(resp_json["return value"])
+
+
+@load_data(
+    APP,
+    """
+        PatientId,year,AgeStudyStart,Albuterol,AvgDailyPM2.5Exposure,EstResidentialDensity,AsthmaDx
+        varchar(255),int,varchar(255),varchar(255),int,int,int
+        1,2010,0-2,0,1,0,1
+        2,2010,0-2,1,1,0,1
+        3,2010,0-2,>1,1,0,1
+        4,2010,0-2,0,2,0,1
+        5,2010,0-2,1,2,0,1
+        6,2010,0-2,>1,2,0,1
+        7,2010,0-2,0,3,0,1
+        8,2010,0-2,1,3,0,1
+        9,2010,0-2,>1,3,0,1
+        10,2010,0-2,0,4,0,1
+        11,2010,0-2,1,4,0,1
+        12,2010,0-2,>1,4,0,1
+    """,
+    """
+        cohort_id,size,features,table,year
+        COHORT:1,12,"{}",patient,2010
+    """
+)
+def test_feature_association2_combined_bins():
+    cohort_id = "COHORT:1"
+    atafdata = {
+        "feature_a": {
+            "feature_name": "AvgDailyPM2.5Exposure",
+            "feature_qualifiers": [
+                {"operator": "in", "values": ["1", "2"]},
+                {"operator": "=", "value": 3},
+                {"operator": ">=", "value": 4},
+            ]
+        },
+        "feature_b": {
+            "feature_name": "Albuterol",
+            "feature_qualifiers": [
+                {"operator": "=", "value": "0"},
+                {"operator": "in", "values": ["1", ">1"]},
+            ]
+        },
+    }
+    resp = testclient.post(
+        f"/{table}/cohort/{cohort_id}/feature_association2",
+        json=atafdata,
+    )
+    resp_json = resp.json()
+    assert "return value" in resp_json
+    do_verify_feature_matrix_response(resp_json["return value"])
+    feature_matrix = resp_json["return value"]["feature_matrix"]
+    assert [
+        [cell["frequency"] for cell in row]
+        for row in feature_matrix
+    ] == [[2, 1, 1], [4, 2, 2]]
+    assert [
+        row["frequency"] for row in resp_json["return value"]["rows"]
+    ] == [4, 8]
+    assert [
+        col["frequency"] for col in resp_json["return value"]["columns"]
+    ] == [6, 3, 3]
+    assert resp_json["return value"]["total"] == 12
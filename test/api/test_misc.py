@@ -49,6 +49,40 @@ def test_post_cohort():
     assert "size" in resp_json["return value"]
 
 
+@load_data(
+    APP,
+    """
+        PatientId,year,AgeStudyStart,Albuterol,AvgDailyPM2.5Exposure,EstResidentialDensity,AsthmaDx
+        varchar(255),int,varchar(255),varchar(255),int,int,int
+        1,2010,0-2,0,1,0,1
+        2,2010,0-2,1,1,0,1
+        3,2010,0-2,>1,1,0,1
+        4,2010,0-2,0,2,0,1
+        5,2010,0-2,1,2,0,1
+        6,2010,0-2,>1,2,0,1
+        7,2010,0-2,0,3,0,1
+        8,2010,0-2,1,3,0,1
+        9,2010,0-2,>1,3,0,1
+        10,2010,0-2,0,4,0,1
+        11,2010,0-2,1,4,0,1
+        12,2010,0-2,>1,4,0,1
+    """,
+    """
+        cohort_id,size,features,table,year
+        COHORT:1,12,"{}",patient,2010
+        COHORT:7,12,"{}",patient,2011
+        my-cohort,12,"{}",patient,2012
+    """
+)
+def test_post_cohort_next_id():
+    """Test that new cohort ids follow the largest one in use."""
+    resp = testclient.post(
+        f"/{table}/cohort",
+        json={},
+    )
+    assert resp.json()["return value"]["cohort_id"] == "COHORT:8"
+
+
 @load_data(
     APP,
     """
@@ -133,6 +167,51 @@ def test_feature_count_cohort_features_two_years():
     do_verify_feature_count_response(resp_json["return value"])
 
 
+@load_data(
+    APP,
+    """
+        PatientId,year,AgeStudyStart,Albuterol,AvgDailyPM2.5Exposure,EstResidentialDensity,AsthmaDx
+        varchar(255),int,varchar(255),varchar(255),int,int,int
+        1,2010,0-2,0,1,0,1
+        2,2010,0-2,1,1,0,1
+        3,2010,0-2,>1,1,0,1
+        4,2010,0-2,0,2,0,1
+        5,2010,0-2,1,2,0,1
+        6,2010,0-2,>1,2,0,1
+        7,2010,0-2,0,3,0,1
+        8,2010,0-2,1,3,0,1
+        9,2010,0-2,>1,3,0,1
+        10,2010,0-2,0,4,0,1
+        11,2010,0-2,1,4,0,1
+        12,2010,0-2,>1,4,0,1
+    """,
+    """
+        cohort_id,size,features,table,year
+        COHORT:1,6,"{0}",patient,2010
+    """.format(escape_quotes(json.dumps({
+        "AvgDailyPM2.5Exposure": {"operator": "<", "value": 3},
+    })))
+)
+def test_feature_count_cohort_features():
+    """Test that cohort features restrict the feature counts."""
+    cohort_id = "COHORT:1"
+
+    resp = testclient.get(
+        f"/{table}/cohort/{cohort_id}/features",
+    )
+    resp_json = resp.json()
+    assert "return value" in resp_json
+    do_verify_feature_count_response(resp_json["return value"])
+    counts = {
+        feature_count["feature"]["feature_name"]: [
+            stats["frequency"] for stats in feature_count["feature_matrix"]
+        ]
+        for feature_count in resp_json["return value"]
+    }
+    assert counts["Albuterol"] == [2, 2, 2]
+    assert counts["AvgDailyPM2.5Exposure"] == [3, 3]
+
+
 @load_data(
     APP,
     """
@@ -173,6 +252,23 @@ def test_cohort_dictionary_explicit_tabular():
     assert resp.status_code == 200
 
 
+@load_data(
+    APP,
+    """
+        PatientId,year,AgeStudyStart,Albuterol
+        varchar(255),int,varchar(255),varchar(255)
+        1,2010,0-2,0
+    """,
+)
+def test_refresh_metadata():
+    """Test refreshing the shared table metadata."""
+    resp = testclient.post("/metadata/refresh")
+    resp_json = resp.json()
+    assert "return value" in resp_json
+    assert "patient" in resp_json["return value"]["tables"]
+    assert "cohort" in resp_json["return value"]["tables"]
+
+
 def test_openapi():
     response = testclient.get("/openapi.json")
 
@@ -0,0 +1,57 @@
+"""Test /multivariate_feature_analysis."""
+from fastapi.testclient import TestClient
+
+from icees_api.app import APP
+
+from ..util import load_data
+
+testclient = TestClient(APP)
+
+
+@load_data(
+    APP,
+    """
+        PatientId,year,AgeStudyStart,Albuterol,AvgDailyPM2.5Exposure,EstResidentialDensity,AsthmaDx
+        varchar(255),int,varchar(255),varchar(255),int,int,int
+        1,2010,0-2,0,1,0,1
+        2,2010,0-2,1,1,0,1
+        3,2010,3-17,>1,1,0,1
+        4,2010,0-2,0,2,0,1
+        5,2010,0-2,1,2,0,1
+        6,2010,3-17,>1,2,0,1
+        7,2010,0-2,0,3,0,1
+        8,2010,0-2,1,3,0,1
+        9,2010,3-17,>1,3,0,0
+        10,2010,0-2,0,4,0,0
+        11,2010,0-2,1,4,0,0
+        12,2010,3-17,>1,4,0,0
+    """,
+    """
+        cohort_id,size,features,table,year
+        COHORT:1,12,"{}",patient,2010
+    """
+)
+def test_multivariate_feature_analysis():
+    cohort_id = "COHORT:1"
+    resp = testclient.post(
+        f"/cohort/{cohort_id}/multivariate_feature_analysis",
+        json=["AgeStudyStart", "AvgDailyPM2.5Exposure", "AsthmaDx"],
+    )
+    resp_json = resp.json()
+    assert "return value" in resp_json
+    table = resp_json["return value"]
+    # 6 AgeStudyStart levels x 5 AvgDailyPM2.5Exposure levels x 2 AsthmaDx levels
+    assert len(table) == 60
+    assert sum(row["frequency"] for row in table) == 12
+    frequencies = {
+        (
+            row["AgeStudyStart"]["value"],
+            row["AvgDailyPM2.5Exposure"]["value"],
+            row["AsthmaDx"]["value"],
+        ): row["frequency"]
+        for row in table
+    }
+    assert frequencies[("0-2", 1, 1)] == 2
+    assert frequencies[("3-17", 3, 0)] == 1
+    assert frequencies[("3-17", 3, 1)] == 0
+    assert frequencies[("0-2", 5, 1)] == 0
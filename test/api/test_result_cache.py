@@ -0,0 +1,207 @@
+"""Test the Redis result cache."""
+import json
+
+from fastapi.testclient import TestClient
+import redis
+
+from icees_api.app import APP
+from icees_api.features import cache
+
+from ..util import load_data, escape_quotes
+
+testclient = TestClient(APP)
+table = "patient"
+cohort_features = {
+    "AsthmaDx": {"operator": "=", "value": 1},
+}
+data = """
+    PatientId,year,AgeStudyStart,Albuterol,AvgDailyPM2.5Exposure,EstResidentialDensity,AsthmaDx
+    varchar(255),int,varchar(255),varchar(255),int,int,int
+    1,2010,0-2,0,1,0,1
+    2,2010,0-2,1,1,0,1
+    3,2010,0-2,1,1,0,0
+    4,2010,0-2,0,2,0,1
+    5,2010,0-2,1,2,1,1
+    6,2010,0-2,0,2,0,0
+    7,2010,0-2,0,3,1,1
+    8,2010,0-2,1,3,0,1
+"""
+cohort_data = """
+    cohort_id,size,features,table,year
+    COHORT:1,6,"{0}",patient,
+""".format(escape_quotes(json.dumps(cohort_features, sort_keys=True)))
+atafdata = {
+    "feature_a": {
+        "feature_name": "Albuterol",
+        "feature_qualifiers": [
+            {"operator": "=", "value": "0"},
+            {"operator": "=", "value": "1"},
+        ]
+    },
+    "feature_b": {
+        "feature_name": "EstResidentialDensity",
+        "feature_qualifiers": [
+            {"operator": "=", "value": 0},
+            {"operator": "=", "value": 1},
+        ]
+    },
+}
+
+
+class FakeRedis():
+    """In-memory stand-in for a Redis client."""
+
+    def __init__(self):
+        """Initialize."""
+        self.store = {}
+        self.hits = 0
+
+    def get(self, key):
+        """Get value."""
+        if key in self.store:
+            self.hits += 1
+        return self.store.get(key)
+
+    def set(self, key, value, ex=None):
+        """Set value."""
+        self.store[key] = value
+
+    def delete(self, key):
+        """Delete value."""
+        self.store.pop(key, None)
+
+
+def enable_cache(monkeypatch, client, maxsize=2 ** 20):
+    """Enable the result cache with empty tiers."""
+    monkeypatch.setattr(cache, "RESULT_CACHE", True)
+    monkeypatch.setattr(cache, "r", client)
+    monkeypatch.setattr(cache, "LOCAL", cache.LRUCache(maxsize, 60))
+    monkeypatch.setattr(cache, "STATS", cache.CacheStats())
+
+
+def get_stats(tier, endpoint):
+    """Get the cache statistics of a tier and endpoint."""
+    resp = testclient.get("/cache/stats")
+    for record in resp.json()["return value"]:
+        if (record["tier"], record["endpoint"]) == (tier, endpoint):
+            return record
+    return None
+
+
+class DownRedis():
+    """Redis client whose server is unreachable."""
+
+    def get(self, key):
+        """Fail."""
+        raise redis.ConnectionError("connection refused")
+
+    set = delete = get
+
+
+@load_data(APP, data, cohort_data)
+def test_cached_feature_association(monkeypatch):
+    """Test that repeated feature associations are read from the cache."""
+    cohort_id = "COHORT:1"
+    expected = testclient.post(
+        f"/{table}/cohort/{cohort_id}/feature_association2",
+        json=atafdata,
+    ).json()
+    assert expected["return value"]["total"] == 6
+
+    fake = FakeRedis()
+    enable_cache(monkeypatch, fake)
+    for _ in range(2):
+        resp = testclient.post(
+            f"/{table}/cohort/{cohort_id}/feature_association2",
+            json=atafdata,
+        )
+        assert resp.json() == expected
+    assert fake.hits == 1
+    assert all(key.startswith("icees:") for key in fake.store)
+
+
+@load_data(APP, data, cohort_data)
+def test_cached_features(monkeypatch):
+    """Test that cached feature counts match uncached ones."""
+    cohort_id = "COHORT:1"
+    expected = testclient.get(f"/{table}/cohort/{cohort_id}/features").json()
+
+    fake = FakeRedis()
+    enable_cache(monkeypatch, fake)
+    for _ in range(2):
+        resp = testclient.get(f"/{table}/cohort/{cohort_id}/features")
+        assert resp.json() == expected
+    # the second request is served by the in-process tier
+    assert fake.hits == 0
+    stats = get_stats("local", "features")
+    assert stats["hits"] == 2  # cohort definition and feature counts
+    assert stats["misses"] == 2
+
+    # a new process starts with an empty in-process tier
+    monkeypatch.setattr(cache, "LOCAL", cache.LRUCache(2 ** 20, 60))
+    resp = testclient.get(f"/{table}/cohort/{cohort_id}/features")
+    assert resp.json() == expected
+    assert fake.hits == 2
+    assert get_stats("redis", "features")["hits"] == 2
+
+
+def test_local_cache_eviction(monkeypatch):
+    """Test that the in-process tier evicts least recently used entries."""
+    monkeypatch.setattr(cache, "STATS", cache.CacheStats())
+    local = cache.LRUCache(10, 60)
+    local.set("a", "A", 4)
+    local.set("b", "B", 4)
+    assert local.get("a") == "A"
+    local.set("c", "C", 4)
+    assert local.get("b") is None
+    assert local.get("a") == "A"
+    assert local.get("c") == "C"
+    assert local.size == 8
+    local.set("d", "D", 11)
+    assert local.get("d") is None
+    assert cache.STATS.as_list() == [{
+        "tier": "local",
+        "endpoint": None,
+        "hits": 0,
+        "misses": 0,
+        "evictions": 1,
+    }]
+
+
+@load_data(APP, data + """
+    9,2010,0-2,0,1,0,1
+    10,2010,0-2,1,1,0,1
+    11,2010,0-2,1,1,0,0
+""", cohort_data)
+def test_cohort_dictionary_invalidation(monkeypatch):
+    """Test that creating a cohort invalidates the cohort dictionary."""
+    fake = FakeRedis()
+    enable_cache(monkeypatch, fake)
+    resp = testclient.get(f"/{table}/cohort/dictionary")
+    assert len(resp.json()["return value"]) == 1
+    key = next(key for key in fake.store if ":get_cohort_dictionary:" in key)
+    assert cache.LOCAL.get(key) is not None
+
+    resp = testclient.post(f"/{table}/cohort", json={})
+    assert resp.json()["return value"]["cohort_id"] == "COHORT:2"
+    assert key not in fake.store
+    assert cache.LOCAL.get(key) is None
+
+
+@load_data(APP, data, cohort_data)
+def test_redis_unavailable(monkeypatch):
+    """Test that results are computed when Redis is unreachable."""
+    cohort_id = "COHORT:1"
+    expected = testclient.post(
+        f"/{table}/cohort/{cohort_id}/feature_association2",
+        json=atafdata,
+    ).json()
+
+    enable_cache(monkeypatch, DownRedis())
+    monkeypatch.setattr(cache, "_unavailable_until", 0.0)
+    resp = testclient.post(
+        f"/{table}/cohort/{cohort_id}/feature_association2",
+        json=atafdata,
+    )
+    assert resp.json() == expected
+    assert cache._unavailable_until > 0
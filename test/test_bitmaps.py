@@ -0,0 +1,23 @@
+"""Test packed bitmaps."""
+import numpy as np
+
+from icees_api.features.bitmaps import Bitmap, index_column
+
+
+def test_bitmap():
+    """Test set operations and counts of bitmaps."""
+    a = np.array([True, False, True, True, False, False, True, False, True, True, False])
+    b = np.array([False, False, True, False, True, False, True, True, True, False, True])
+    bitmap_a, bitmap_b = Bitmap.from_mask(a), Bitmap.from_mask(b)
+    assert (bitmap_a & bitmap_b).count() == np.count_nonzero(a & b)
+    assert ((bitmap_a | bitmap_b).to_mask() == (a | b)).all()
+    assert Bitmap.ones(len(a)).count() == len(a)
+    assert Bitmap.zeros(len(a)).count() == 0
+
+
+def test_index_column():
+    """Test that each value gets the bitmap of its rows, and NULLs none."""
+    codes = np.array([1, 0, -1, 1, 2, 0, 1])
+    bitmaps = index_column(codes, 3)
+    for code, bitmap in enumerate(bitmaps):
+        assert (bitmap.to_mask() == (codes == code)).all()
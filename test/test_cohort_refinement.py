@@ -0,0 +1,94 @@
+"""Test refining materialized cohorts."""
+import pytest
+from sqlalchemy import create_engine, select
+
+from icees_api.db import METADATA
+from icees_api.dependencies import ConnectionWithTables
+from icees_api.features import schema, sql
+
+PARENT = {"AsthmaDx": {"operator": "=", "value": "1"}}
+CHILD = {
+    **PARENT,
+    "Albuterol": {"operator": "in", "values": ["0", ">1"]},
+}
+
+
+@pytest.fixture
+def conn(tmp_path, monkeypatch):
+    """Get a connection to a database of patients, materializing cohorts."""
+    monkeypatch.setattr(sql, "MATERIALIZE_COHORTS", True)
+    engine = create_engine(f"sqlite:///{tmp_path / 'cohorts.db'}")
+    with engine.connect() as connection:
+        connection.execute(
+            "CREATE TABLE patient (PatientId varchar(255), year int, "
+            "Albuterol varchar(255), AsthmaDx int)"
+        )
+        connection.execute("INSERT INTO patient VALUES (?, ?, ?, ?)", [
+            (str(patient), year, ["0", "1", ">1"][(patient + year) % 3], int(patient % 4 > 0))
+            for patient in range(40)
+            for year in (2010, 2011)
+        ])
+        connection.execute(
+            "CREATE TABLE cohort (cohort_id varchar(255), size int, "
+            "\"table\" varchar(255), year int, features varchar(255))"
+        )
+        conn = ConnectionWithTables(connection, METADATA.refresh(connection))
+        schema.migrate(conn)
+        yield conn
+    engine.dispose()
+
+
+def members(conn, cohort_id):
+    """Get the materialized members of a cohort."""
+    return set(map(tuple, conn.execute(schema.select_cohort_members(conn, cohort_id))))
+
+
+def test_refine_parent_cohort(conn, monkeypatch):
+    """Test that a cohort adding features to a stored one refines its members."""
+    child_features_norm = sql.normalize_features(None, CHILD)
+    expected_size = sql.count_cohort(conn, "patient", None, child_features_norm)
+    table_ = sql.cohort_table(conn, "patient", CHILD)
+    expected_members = set(map(tuple, conn.execute(
+        select([table_.c["PatientId"], table_.c["year"]]).distinct()
+    )))
+
+    parent_id, _ = sql.select_cohort(conn, "patient", None, PARENT)
+    assert sql.find_parent_cohort(conn, "patient", child_features_norm) == (
+        parent_id, [child_features_norm[0]],
+    )
+
+    monkeypatch.setattr(sql, "count_cohort", None)
+    monkeypatch.setattr(sql, "cohort_table", None)
+    cohort_id, size = sql.select_cohort(conn, "patient", None, CHILD)
+    assert size == expected_size
+    assert members(conn, cohort_id) == expected_members
+
+
+def test_no_parent_cohort(conn):
+    """Test that only materialized cohorts with a subset of the features are parents."""
+    child_features_norm = sql.normalize_features(None, CHILD)
+    sql.select_cohort(conn, "patient", 2010, PARENT)
+    sql.select_cohort(conn, "patient", None, {
+        "Albuterol": {"operator": "=", "value": "1"},
+    })
+    assert sql.find_parent_cohort(conn, "patient", child_features_norm) is None
+
+    # a cohort is not its own parent
+    sql.select_cohort(conn, "patient", None, CHILD)
+    assert sql.find_parent_cohort(conn, "patient", child_features_norm) is None
+    assert sql.find_parent_cohort(conn, "patient", sql.normalize_features(2010, {
+        **CHILD, "year": {"operator": "=", "value": "2010"},
+    })) is None
+
+
+def test_no_parent_with_duplicate_patient_years(conn):
+    """Test that rows failing the parent's features do not join back in."""
+    # patient 1 has another 2010 row, with the child's extra feature but
+    # not the parent's
+    conn.execute("INSERT INTO patient VALUES ('1', 2010, '0', 0)")
+    child_features_norm = sql.normalize_features(None, CHILD)
+    expected = sql.count_cohort(conn, "patient", None, child_features_norm)
+    sql.select_cohort(conn, "patient", None, PARENT)
+    assert sql.find_parent_cohort(conn, "patient", child_features_norm) is None
+    _, size = sql.select_cohort(conn, "patient", None, CHILD)
+    assert size == expected
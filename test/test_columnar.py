@@ -0,0 +1,142 @@
+"""Test the columnar in-memory engine against SQL."""
+import pytest
+from sqlalchemy import create_engine
+
+from icees_api.db import METADATA
+from icees_api.dependencies import ConnectionWithTables
+from icees_api.features import columnar, sql
+
+ROWS = [
+    # PatientId, year, AgeStudyStart, Albuterol, AvgDailyPM2.5Exposure, AsthmaDx
+    ("1", 2010, "0-2", "0", 1, 1),
+    ("1", 2011, "0-2", "1", 2, 1),
+    ("2", 2010, "0-2", "1", 1, 1),
+    ("2", 2011, "3-17", ">1", 1, 0),
+    ("3", 2010, "3-17", ">1", None, 1),
+    ("4", 2010, "0-2", "0", 2, None),
+    ("5", 2011, "3-17", "1", 3, 1),
+    ("5", 2011, "3-17", "0", 4, 1),
+    (None, 2010, "0-2", "0", 4, 1),
+]
+COHORTS = [
+    [],
+    [{"feature_name": "AsthmaDx", "feature_qualifier": {"operator": "=", "value": 1}}],
+    [{"feature_name": "AgeStudyStart", "feature_qualifier": {"operator": "in", "values": ["3-17"]}}],
+    [
+        {"feature_name": "AvgDailyPM2.5Exposure", "feature_qualifier": {"operator": ">", "value": 1}},
+        {"feature_name": "AsthmaDx", "feature_qualifier": {"operator": "<>", "value": "0"}},
+    ],
+    [
+        {"feature_name": "AsthmaDx", "feature_qualifier": {"operator": "=", "value": 1}, "year": 2010},
+        {"feature_name": "Albuterol", "feature_qualifier": {"operator": "=", "value": "1"}, "year": 2011},
+    ],
+    [{"feature_name": "AvgDailyPM2.5Exposure", "feature_qualifier": {
+        "operator": "between", "value_a": 2, "value_b": 3,
+    }}],
+]
+
+
+@pytest.fixture
+def conn():
+    """Get a connection to a database with a patient table."""
+    engine = create_engine("sqlite://")
+    with engine.connect() as connection:
+        connection.execute(
+            "CREATE TABLE patient (PatientId varchar(255), year int, "
+            "AgeStudyStart varchar(255), Albuterol varchar(255), "
+            "\"AvgDailyPM2.5Exposure\" int, AsthmaDx int)"
+        )
+        connection.execute("INSERT INTO patient VALUES (?, ?, ?, ?, ?, ?)", ROWS)
+        yield ConnectionWithTables(connection, METADATA.refresh(connection))
+    engine.dispose()
+
+
+def both(monkeypatch, func, *args, **kwargs):
+    """Get the results of SQL and of the columnar engine, which must not fall back."""
+    expected = func(*args, **kwargs)
+    with monkeypatch.context() as patch:
+        patch.setattr(columnar, "ENABLED", True)
+        patch.setattr(sql, "cohort_table", None)
+        patch.setattr(sql, "generate_tables_from_features", None)
+        return expected, func(*args, **kwargs)
+
+
+@pytest.mark.parametrize("cohort_features", COHORTS)
+@pytest.mark.parametrize("year", [None, 2010])
+def test_count_unique(conn, monkeypatch, cohort_features, year):
+    """Test counting unique value combinations."""
+    expected, result = both(
+        monkeypatch, sql.count_unique, conn, "patient", year,
+        "AgeStudyStart", "AvgDailyPM2.5Exposure",
+        cohort_features=cohort_features,
+    )
+    assert sorted(result) == sorted(expected)
+
+    expected, result = both(
+        monkeypatch, sql.count_unique_pairs, conn, "patient", year,
+        "AgeStudyStart", ["Albuterol", "AgeStudyStart"],
+        cohort_features=cohort_features,
+    )
+    assert {key: sorted(value) for key, value in result.items()} \
+        == {key: sorted(value) for key, value in expected.items()}
+
+
+def test_count_unique_pairs_in_chunks(conn, monkeypatch):
+    """Test counting pairs with more columns than fit in one row."""
+    monkeypatch.setattr(sql, "MAX_ENTRIES_PER_ROW", 2)
+    expected, result = both(
+        monkeypatch, sql.count_unique_pairs, conn, "patient", None,
+        "AgeStudyStart", ["Albuterol", "AgeStudyStart", "AsthmaDx", "AvgDailyPM2.5Exposure"],
+    )
+    assert {key: sorted(value) for key, value in result.items()} \
+        == {key: sorted(value) for key, value in expected.items()}
+
+
+@pytest.mark.parametrize("cohort_features", COHORTS)
+@pytest.mark.parametrize("year", [None, 2010, 2011])
+def test_count_values(conn, monkeypatch, cohort_features, year):
+    """Test counting the values of features, NULLs included."""
+    expected, result = both(
+        monkeypatch, sql.count_values, conn, "patient", year,
+        cohort_features, year, ["Albuterol", "AsthmaDx", "AvgDailyPM2.5Exposure"],
+    )
+    assert result == expected
+
+
+@pytest.mark.parametrize("cohort_features", COHORTS)
+@pytest.mark.parametrize("year", [None, 2011])
+def test_count_cohort(conn, monkeypatch, cohort_features, year):
+    """Test counting the patients of a cohort."""
+    cohort_features_norm = sql.normalize_features(year, cohort_features)
+    expected, result = both(
+        monkeypatch, sql.count_cohort, conn, "patient", year, cohort_features_norm,
+    )
+    assert result == expected
+
+
+def test_count_cohort_by_popcount(conn, monkeypatch):
+    """Test counting cohorts of one row per patient and year from bitmaps."""
+    conn.execute("DELETE FROM patient WHERE PatientId IS NULL OR \"AvgDailyPM2.5Exposure\" = 4")
+    columnar.STORE.clear(conn)
+    assert columnar.STORE.get(conn, "patient").unique_patient_years
+    monkeypatch.setattr(columnar.ColumnarTable, "patient_weights", None)
+    for cohort_features in COHORTS[:4]:
+        cohort_features_norm = sql.normalize_features(2010, cohort_features)
+        expected, result = both(
+            monkeypatch, sql.count_cohort, conn, "patient", 2010, cohort_features_norm,
+        )
+        assert result == expected
+
+
+def test_unsupported(conn, monkeypatch):
+    """Test that comparisons the engine cannot reproduce fall back to SQL."""
+    table_ = columnar.STORE.get(conn, "patient")
+    with pytest.raises(columnar.Unsupported):
+        table_.predicate("AsthmaDx", {"operator": "=", "value": "yes"})
+    with pytest.raises(columnar.Unsupported):
+        table_.predicate("Unknown", {"operator": "=", "value": "1"})
+
+    monkeypatch.setattr(columnar, "ENABLED", True)
+    assert sql.count_unique(conn, "patient", None, "AsthmaDx", cohort_features={
+        "AsthmaDx": {"operator": "=", "value": "yes"},
+    }) == []
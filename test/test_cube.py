@@ -0,0 +1,107 @@
+"""Test precomputed pairwise counts."""
+from itertools import combinations_with_replacement
+
+import pytest
+from sqlalchemy import create_engine
+
+from icees_api.db import METADATA
+from icees_api.dependencies import ConnectionWithTables
+from icees_api.features import columnar, cube, sql
+
+ROWS = [
+    # PatientId, year, AgeStudyStart, Albuterol, AvgDailyPM2.5Exposure, AsthmaDx
+    ("1", 2010, "0-2", "0", 1, 1),
+    ("1", 2011, "0-2", "1", 2, 1),
+    ("2", 2010, "0-2", "1", 1, 1),
+    ("2", 2011, "3-17", ">1", 1, 0),
+    ("3", 2010, "3-17", ">1", None, 1),
+    ("4", 2010, "0-2", "0", 2, None),
+    ("5", 2011, "3-17", "1", 3, 1),
+]
+FEATURES = ["AgeStudyStart", "Albuterol", "AvgDailyPM2.5Exposure", "AsthmaDx"]
+
+
+@pytest.fixture
+def conn(tmp_path, monkeypatch):
+    """Get a connection to a database with a patient table and its cube."""
+    engine = create_engine("sqlite://")
+    with engine.connect() as connection:
+        connection.execute(
+            "CREATE TABLE patient (PatientId varchar(255), year int, "
+            "AgeStudyStart varchar(255), Albuterol varchar(255), "
+            "\"AvgDailyPM2.5Exposure\" int, AsthmaDx int)"
+        )
+        connection.execute("INSERT INTO patient VALUES (?, ?, ?, ?, ?, ?)", ROWS)
+        conn = ConnectionWithTables(connection, METADATA.refresh(connection))
+        cube.build_cube(conn, "patient", tmp_path / "patient.cube")
+        monkeypatch.setattr(cube, "CUBE_PATH", str(tmp_path))
+        monkeypatch.setattr(cube, "_cubes", {})
+        yield conn
+    engine.dispose()
+
+
+def from_cube(monkeypatch, func, *args, **kwargs):
+    """Get the results of SQL and of the cube, which must not fall back."""
+    with monkeypatch.context() as patch:
+        patch.setattr(cube, "CUBE_PATH", None)
+        expected = func(*args, **kwargs)
+    with monkeypatch.context() as patch:
+        patch.setattr(sql, "cohort_table", None)
+        patch.setattr(sql, "generate_tables_from_features", None)
+        return expected, func(*args, **kwargs)
+
+
+@pytest.mark.parametrize("year", [None, 2010, 2011])
+def test_unfiltered(conn, monkeypatch, year):
+    """Test counting pairs of every pair of features."""
+    for feature_a, feature_b in combinations_with_replacement(FEATURES, 2):
+        for columns in [(feature_a, feature_b), (feature_b, feature_a)]:
+            expected, result = from_cube(
+                monkeypatch, sql.count_unique, conn, "patient", year, *columns,
+            )
+            assert sorted(result) == sorted(expected)
+        expected, result = from_cube(
+            monkeypatch, sql.count_unique, conn, "patient", year, feature_a,
+        )
+        assert sorted(result) == sorted(expected)
+
+
+@pytest.mark.parametrize("year", [None, 2010])
+def test_single_equality(conn, monkeypatch, year):
+    """Test counting pairs of a cohort of one equality on one of the features."""
+    for value in [1, "0"]:
+        cohort_features = {"AsthmaDx": {"operator": "=", "value": value}}
+        expected, result = from_cube(
+            monkeypatch, sql.count_unique_pairs, conn, "patient", year,
+            "AsthmaDx", FEATURES, cohort_features=cohort_features,
+        )
+        assert {key: sorted(value) for key, value in result.items()} \
+            == {key: sorted(value) for key, value in expected.items()}
+
+
+@pytest.mark.parametrize("year, cohort_year", [
+    (None, None), ("2010", None), ("2011", 2011),
+])
+def test_count_values(conn, monkeypatch, year, cohort_year):
+    """Test counting the values of features in the unfiltered cohort."""
+    expected, result = from_cube(
+        monkeypatch, sql.count_values, conn, "patient", year, {}, cohort_year, FEATURES,
+    )
+    assert result == expected
+
+
+def test_fall_back(conn, monkeypatch):
+    """Test that other cohorts, and stale cubes, are counted by SQL."""
+    with pytest.raises(columnar.Unsupported):
+        cube.count_unique("patient", None, FEATURES[:2], sql.normalize_features(None, {
+            "AsthmaDx": {"operator": "=", "value": 1},
+        }))
+    with pytest.raises(columnar.Unsupported):
+        cube.count_unique("patient", 2012, FEATURES[:2], [])
+    with pytest.raises(columnar.Unsupported):
+        cube.count_values("patient", 2010, [], 2011, FEATURES)
+
+    monkeypatch.setattr(cube, "DATA_VERSION", "2")
+    monkeypatch.setattr(cube, "_cubes", {})
+    with pytest.raises(columnar.Unsupported):
+        cube.count_unique("patient", None, FEATURES[:2], [])
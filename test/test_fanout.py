@@ -0,0 +1,68 @@
+"""Test fanning queries out across connections."""
+import threading
+
+import pytest
+from sqlalchemy import create_engine
+
+from icees_api.db import METADATA
+from icees_api.dependencies import ConnectionWithTables
+from icees_api.features import fanout
+
+
+@pytest.fixture
+def conn(tmp_path):
+    """Get a connection to a SQLite database file."""
+    engine = create_engine(f"sqlite:///{tmp_path / 'fanout.db'}")
+    with engine.connect() as connection:
+        connection.execute("CREATE TABLE numbers (n int)")
+        connection.execute("INSERT INTO numbers VALUES (1), (2), (3)")
+        yield ConnectionWithTables(connection, METADATA.get(connection))
+    engine.dispose()
+
+
+def test_fan_out(conn, monkeypatch):
+    """Test that results are ordered and computed on several connections."""
+    monkeypatch.setattr(fanout, "FANOUT_WORKERS", 3)
+    threads = set()
+
+    def query(conn, i):
+        threads.add(threading.get_ident())
+        return i, conn.execute("SELECT SUM(n) FROM numbers").scalar()
+
+    assert fanout.fan_out(conn, query, range(20)) == [(i, 6) for i in range(20)]
+    assert threading.get_ident() not in threads
+
+
+def test_fan_out_first_error(conn, monkeypatch):
+    """Test that the error of the first failed item is raised."""
+    monkeypatch.setattr(fanout, "FANOUT_WORKERS", 3)
+
+    def query(conn, i):
+        if i in (3, 7):
+            raise RuntimeError(f"item {i}")
+        return i
+
+    with pytest.raises(RuntimeError, match="item 3"):
+        fanout.fan_out(conn, query, range(10))
+
+
+def test_fan_out_disconnected(conn, monkeypatch):
+    """Test that no work is started once the client is gone."""
+    monkeypatch.setattr(fanout, "FANOUT_WORKERS", 1)
+    started = []
+    token = fanout.DISCONNECTED.set(lambda: bool(started))
+    try:
+        with pytest.raises(fanout.Cancelled):
+            fanout.fan_out(conn, lambda conn, i: started.append(i), range(5))
+    finally:
+        fanout.DISCONNECTED.reset(token)
+    assert started == [0]
+
+
+def test_in_memory_serial(monkeypatch):
+    """Test that in-memory databases are queried on their own connection."""
+    monkeypatch.setattr(fanout, "FANOUT_WORKERS", 3)
+    with create_engine("sqlite://").connect() as connection:
+        conn = ConnectionWithTables(connection, {})
+        assert fanout.workers(conn) == 1
+        assert fanout.fan_out(conn, lambda conn_, i: conn_ is conn, range(3)) == [True] * 3
@@ -0,0 +1,70 @@
+"""Test the index advisor."""
+import json
+
+import pytest
+from sqlalchemy import create_engine, inspect
+
+from icees_api.db import METADATA
+from icees_api.dependencies import ConnectionWithTables
+from icees_api.features import indexes
+
+
+@pytest.fixture
+def conn(tmp_path):
+    """Get a connection to a database with feature and cohort tables."""
+    engine = create_engine(f"sqlite:///{tmp_path / 'features.db'}")
+    with engine.connect() as connection:
+        connection.execute(
+            "CREATE TABLE patient (PatientId varchar(255), year int, "
+            "AgeStudyStart varchar(255), Sex2 varchar(255), \"AvgDailyPM2.5Exposure\" int)"
+        )
+        connection.execute(
+            "CREATE TABLE cohort (cohort_id varchar(255), size int, "
+            "\"table\" varchar(255), year int, features varchar(255))"
+        )
+        cohorts = [
+            {"AgeStudyStart": {"operator": "=", "value": "0-2"}},
+            {"AgeStudyStart": {"operator": "=", "value": "3-17"}, "Sex2": {"operator": "=", "value": "Male"}},
+            [{"feature_name": "AvgDailyPM2.5Exposure", "feature_qualifier": {"operator": ">", "value": 1}}],
+            [{"feature_name": "AvgDailyPM2.5Exposure", "feature_qualifier": {"operator": "<", "value": 3}}],
+        ]
+        for index, features in enumerate(cohorts):
+            connection.execute(
+                "INSERT INTO cohort VALUES (?, 20, 'patient', 2010, ?)",
+                f"COHORT:{index + 1}", json.dumps(features),
+            )
+        yield ConnectionWithTables(connection, METADATA.refresh(connection))
+    engine.dispose()
+
+
+def test_advise_and_create(conn):
+    """Test that created indexes are no longer advised."""
+    advice = indexes.advise(conn, min_cohorts=2)
+    assert [index.columns for index in advice] == [
+        ["PatientId"],
+        ["year", "PatientId"],
+        ["AgeStudyStart"],
+        ["AvgDailyPM2.5Exposure"],
+    ]
+    assert advice[-1].name == "ix_patient_AvgDailyPM2_5Exposure"
+
+    created = indexes.create_indexes(conn, advice)
+    assert created == advice
+    assert {
+        index["name"] for index in inspect(conn.connection).get_indexes("patient")
+    } == {index.name for index in advice}
+    assert indexes.advise(conn, min_cohorts=2) == []
+
+
+def test_leading_columns(conn):
+    """Test that an index covers its leading columns."""
+    conn.execute("CREATE INDEX ix_year_patient ON patient (year, PatientId)")
+    advice = indexes.advise(conn, min_cohorts=3)
+    assert [index.columns for index in advice] == [["PatientId"]]
+
+
+def test_index_name():
+    """Test that index names fit PostgreSQL identifiers."""
+    name = indexes.index_name("patient", ["year", "x" * 80])
+    assert len(name) == indexes.MAX_NAME_LENGTH
+    assert name != indexes.index_name("patient", ["year", "x" * 81])
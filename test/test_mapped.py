@@ -0,0 +1,23 @@
+"""Test memory-mapped array files."""
+import numpy as np
+import pytest
+
+from icees_api.features import mapped
+
+
+def test_round_trip(tmp_path):
+    """Test that arrays are mapped back read-only, with their metadata."""
+    arrays = {
+        "counts": np.arange(10, dtype=np.int64).reshape(2, 5),
+        "codes": np.array([3, -1, 2], dtype=np.int8),
+        "empty": np.empty(0, dtype=np.int32),
+    }
+    mapped.save(tmp_path / "counts.map", {"years": [None, 2010]}, arrays)
+    meta, loaded = mapped.load(tmp_path / "counts.map")
+    assert meta == {"years": [None, 2010]}
+    for name, array in arrays.items():
+        assert loaded[name].dtype == array.dtype
+        assert (loaded[name] == array).all()
+    with pytest.raises(ValueError):
+        loaded["counts"][0, 0] = 1
+    assert list(tmp_path.iterdir()) == [tmp_path / "counts.map"]
@@ -0,0 +1,87 @@
+"""Test the query plans of cohort scans, and their reuse."""
+import pytest
+from sqlalchemy import column, create_engine, event, func, select
+from sqlalchemy.engine.default import CACHE_HIT
+
+from icees_api.db import METADATA
+from icees_api.dependencies import ConnectionWithTables
+from icees_api.features import columnar, sql
+
+ASTHMA_2010 = {
+    "feature_name": "AsthmaDx",
+    "feature_qualifier": {"operator": "=", "value": 1},
+    "year": 2010,
+}
+ALBUTEROL_2011 = {
+    "feature_name": "Albuterol",
+    "feature_qualifier": {"operator": "=", "value": "1"},
+    "year": 2011,
+}
+
+
+@pytest.fixture
+def conn():
+    """Get a connection to a database with a patient table."""
+    engine = create_engine("sqlite://")
+    with engine.connect() as connection:
+        connection.execute(
+            "CREATE TABLE patient (PatientId varchar(255), year int, "
+            "Albuterol varchar(255), AsthmaDx int)"
+        )
+        yield ConnectionWithTables(connection, METADATA.refresh(connection))
+    engine.dispose()
+
+
+def query_plan(conn, cohort_features, cohort_year, columns):
+    """Get the details of the plan counting the patients of a cohort."""
+    table, _, pk = sql.generate_tables_from_features(
+        "patient", cohort_features, cohort_year, columns,
+        one_row_per_year=True,
+    )
+    compiled = select([func.count(column(pk).distinct())]) \
+        .select_from(table) \
+        .compile(conn.connection.engine)
+    params = tuple(compiled.params[key] for key in compiled.positiontup)
+    return [
+        row[-1]
+        for row in conn.connection.exec_driver_sql(
+            "EXPLAIN QUERY PLAN " + str(compiled), params,
+        )
+    ]
+
+
+def test_single_year(conn):
+    """Test that features of the year of the columns filter one scan."""
+    plan = query_plan(conn, [ASTHMA_2010], 2010, [("Albuterol", 2010)])
+    assert plan.count("SCAN patient") == 1
+    assert not any("AUTOMATIC" in detail for detail in plan)
+
+
+@pytest.mark.parametrize("cohort_year, columns", [
+    (None, []),
+    (2010, [("Albuterol", 2010)]),
+])
+def test_semijoin(conn, cohort_year, columns):
+    """Test that features of other years are semijoins, not joins."""
+    plan = query_plan(conn, [ASTHMA_2010, ALBUTEROL_2011], cohort_year, columns)
+    assert plan.count("SCAN patient") == 2
+    assert any(detail.startswith("LIST SUBQUERY") for detail in plan)
+    assert not any("AUTOMATIC" in detail for detail in plan)
+
+
+@pytest.mark.parametrize("year", [2010, None])
+def test_statement_cache(conn, monkeypatch, year):
+    """Test that counts differing only in values reuse the compiled statement."""
+    monkeypatch.setattr(columnar, "ENABLED", False)
+    cache_hits = []
+
+    @event.listens_for(conn.connection.engine, "after_cursor_execute")
+    def record(connection, cursor, statement, parameters, context, executemany):
+        cache_hits.append(context.cache_hit is CACHE_HIT)
+
+    for value in ["0", "1", ">1"]:
+        sql.count_unique(
+            conn, "patient", year and year + len(value), "AsthmaDx",
+            cohort_features={"Albuterol": {"operator": "=", "value": value}},
+        )
+    assert cache_hits == [False, True, True]
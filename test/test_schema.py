@@ -0,0 +1,134 @@
+"""Test tables maintained by ICEES API."""
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from sqlalchemy import create_engine, inspect, literal, literal_column, select
+from sqlalchemy.exc import IntegrityError
+
+from icees_api.db import METADATA
+from icees_api.dependencies import ConnectionWithTables
+from icees_api.features import schema, sql
+
+CREATE_COHORT = (
+    "CREATE TABLE cohort (cohort_id varchar(255), size int, "
+    "\"table\" varchar(255), year int, features varchar(255))"
+)
+
+
+@pytest.fixture
+def engine(tmp_path):
+    """Get an engine of a SQLite database file with a cohort table."""
+    engine = create_engine(f"sqlite:///{tmp_path / 'cohorts.db'}")
+    with engine.connect() as connection:
+        connection.execute(CREATE_COHORT)
+        connection.execute(
+            "INSERT INTO cohort VALUES ('COHORT:3', 12, 'patient', NULL, '{}')"
+        )
+    yield engine
+    engine.dispose()
+
+
+def connect(engine):
+    """Connect, with the current tables."""
+    connection = engine.connect()
+    return ConnectionWithTables(connection, METADATA.refresh(connection))
+
+
+def test_allocate_cohort_ids_concurrently(engine):
+    """Test that concurrent allocations get different ids."""
+    def allocate(_):
+        with engine.connect() as connection:
+            conn = ConnectionWithTables(connection, METADATA.get(connection))
+            return [schema.allocate_cohort_id(conn) for _ in range(20)]
+
+    with ThreadPoolExecutor(4) as executor:
+        cohort_ids = [
+            cohort_id
+            for cohort_ids in executor.map(allocate, range(4))
+            for cohort_id in cohort_ids
+        ]
+    assert sorted(cohort_ids) == sorted(f"COHORT:{i}" for i in range(4, 84))
+
+
+def test_migrate(engine):
+    """Test keying cohorts and indexing their features digests."""
+    conn = connect(engine)
+    schema.migrate(conn)
+    assert "features_digest" in conn.tables["cohort"].c
+    digest = conn.execute("SELECT features_digest FROM cohort").scalar()
+    assert digest == sql.features_digest("{}")
+    indexes = {
+        index["name"]: index
+        for index in inspect(conn.connection).get_indexes("cohort")
+    }
+    assert indexes["ux_cohort_cohort_id"]["unique"]
+    assert indexes["ix_cohort_features_digest"]["column_names"] == [
+        "table", "year", "features_digest",
+    ]
+    assert sql.get_ids_by_feature(conn, "patient", None, {}) == ("COHORT:3", 12)
+
+    # migrations are recorded, and not applied again
+    schema._migrated.pop(engine)
+    schema.migrate(conn)
+    assert {
+        name for (name,) in conn.execute("SELECT name FROM schema_migration")
+    } == {"cohort_primary_key", "cohort_features_digest"}
+
+
+def test_migrate_duplicate_cohort_ids(engine):
+    """Test that duplicate cohort ids only prevent keying cohorts."""
+    with engine.connect() as connection:
+        connection.execute(
+            "INSERT INTO cohort VALUES ('COHORT:3', 13, 'patient', NULL, '{\"AsthmaDx\": 1}')"
+        )
+    conn = connect(engine)
+    schema.migrate(conn)
+    assert "features_digest" in conn.tables["cohort"].c
+    assert {
+        name for (name,) in conn.execute("SELECT name FROM schema_migration")
+    } == {"cohort_features_digest"}
+    for features, digest in conn.execute("SELECT features, features_digest FROM cohort"):
+        assert digest == sql.features_digest(features)
+
+
+def test_allocate_cohort_id_without_key(engine):
+    """Test that allocation skips ids taken explicitly, even if ids are not unique."""
+    with engine.connect() as connection:
+        connection.execute(
+            "INSERT INTO cohort VALUES ('COHORT:3', 13, 'patient', NULL, '{}')"
+        )
+        connection.execute("CREATE TABLE patient (PatientId varchar(255), year int)")
+        connection.execute("INSERT INTO patient VALUES (?, 2010)", [
+            (str(patient),) for patient in range(11)
+        ])
+    conn = connect(engine)
+    schema.migrate(conn)
+    schema.cohort_counter_table(conn)
+    sql.insert_cohort(conn, "COHORT:4", 11, "{}", "patient", 2010)
+    assert sql.select_cohort(conn, "patient", None, {}) == ("COHORT:5", 11)
+
+
+def test_cohorts_without_features_digest(engine):
+    """Test storing and finding cohorts before the digest column is added."""
+    conn = connect(engine)
+    sql.insert_cohort(conn, "COHORT:4", 13, '{"AsthmaDx": 1}', "patient", None)
+    assert sql.get_ids_by_feature(conn, "patient", None, {"AsthmaDx": 1}) == ("COHORT:4", 13)
+
+
+def test_store_cohort_members_atomically(engine):
+    """Test that members are not deleted unless their replacements are stored."""
+    with engine.connect() as connection:
+        connection.execute("CREATE TABLE patient (PatientId varchar(255), year int)")
+    conn = connect(engine)
+    schema.store_cohort_members(conn, "COHORT:3", select([
+        literal("COHORT:3"), literal(schema.DATA_VERSION), literal("1"), literal(2010),
+    ]))
+    schema._materialized[engine].clear()
+    with pytest.raises(IntegrityError):
+        schema.store_cohort_members(conn, "COHORT:3", select([
+            literal("COHORT:3"), literal(schema.DATA_VERSION), literal_column("NULL"), literal(2011),
+        ]))
+    assert list(conn.execute(schema.select_cohort_members(conn, "COHORT:3"))) == [
+        ("1", 2010),
+    ]
+    assert "COHORT:3" not in schema._materialized[engine]
@@ -0,0 +1,55 @@
+"""Test batch contingency table statistics."""
+import numpy as np
+from scipy.stats import chi2_contingency, contingency, fisher_exact
+
+from icees_api.features import stats
+from icees_api.features.stats import eps, table_statistics
+
+
+def test_table_statistics():
+    """Test batch statistics against scipy, one table at a time."""
+    tables = [
+        [[3, 1], [2, 5]],
+        [[4, 6], [1, 2]],
+        [[0, 1], [2, 5]],
+        [[1, 2, 3], [4, 5, 7]],
+        [],
+    ]
+    results = table_statistics(tables)
+    for table, result in zip(tables[:4], results):
+        statistic, p, dof, _ = chi2_contingency(
+            np.array(table) + eps, correction=False,
+        )
+        assert np.isclose(result["chi_squared_statistic"], statistic)
+        assert np.isclose(result["chi_squared_p"], p)
+        assert result["chi_squared_dof"] == dof
+    for table, result in zip(tables[:2], results):
+        odds_ratio, p = fisher_exact(table)
+        assert np.isclose(result["fisher_exact_odds_ratio"], odds_ratio)
+        assert np.isclose(result["fisher_exact_p"], p)
+        sample = contingency.odds_ratio(table, kind="sample")
+        interval = sample.confidence_interval(confidence_level=0.95)
+        assert np.isclose(result["log_odds_ratio"], np.log(sample.statistic))
+        assert np.allclose(
+            result["log_odds_ratio_95_confidence_interval"],
+            np.log([interval.low, interval.high]),
+        )
+    for result in results[2:]:
+        assert result["fisher_exact_p"] is None
+        assert result["log_odds_ratio_95_confidence_interval"] is None
+    assert results[4]["chi_squared_p"] is None
+
+
+def test_table_statistics_process_pool(monkeypatch):
+    """Test that statistics computed in the process pool are the same."""
+    tables = [
+        [[i + 1, 2], [3, 4 + 2 * i]] for i in range(5)
+    ] + [[[1, 2, 3], [4, 5, 7]], []]
+    expected = table_statistics(tables)
+    p_values = [result["chi_squared_p"] for result in expected[:6]]
+    corrected = stats.correct_p_values(p_values, 0.05, "fdr_bh")
+
+    monkeypatch.setattr(stats, "STATS_PROCESSES", 2)
+    monkeypatch.setattr(stats, "STATS_PROCESS_MIN_TABLES", 1)
+    assert table_statistics(tables) == expected
+    assert stats.correct_p_values(p_values, 0.05, "fdr_bh") == corrected
@@ -0,0 +1,29 @@
+"""Test utilities."""
+import json
+
+import numpy as np
+
+from icees_api.features.stats import ConfidenceInterval
+from icees_api.utils import to_json
+
+
+def test_to_json():
+    """Test serializing NaNs, NumPy values and namedtuples."""
+    content = {
+        "p": float("nan"),
+        "odds_ratio": np.float64(2.5),
+        "count": np.int64(3),
+        "counts": np.array([1, 2]),
+        "interval": ConfidenceInterval(low=-1.0, high=np.float64(1.0)),
+        "note": "ratio:NaN",
+        1: "a",
+    }
+    assert json.loads(to_json(content)) == {
+        "p": None,
+        "odds_ratio": 2.5,
+        "count": 3,
+        "counts": [1, 2],
+        "interval": [-1.0, 1.0],
+        "note": "ratio:NaN",
+        "1": "a",
+    }
@@ -8,9 +8,10 @@ from uuid import uuid4
 
 from sqlalchemy import create_engine
 from sqlalchemy.engine import Connection
-from sqlalchemy.ext.automap import automap_base
 
+from icees_api.db import METADATA
 from icees_api.dependencies import get_db, ConnectionWithTables
+from icees_api.features import schema
 
 db_ = os.environ.get("ICEES_DB", "sqlite")
 
@@ -105,13 +106,10 @@ async def get_db_(data: str, cohort_data: str):
 
     await fill_db(conn, data, cohort_data)
 
-    # get tables
-    Base = automap_base()
-    Base.prepare(conn.engine, reflect=True)  # reflect the tables
-    tables = Base.metadata.tables
-
+    conn_ = ConnectionWithTables(conn, METADATA.get(conn))
+    schema.migrate(conn_)
     try:
-        yield ConnectionWithTables(conn, tables)
+        yield conn_
     finally:
         conn.close()
 